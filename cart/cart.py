@@ -3,11 +3,14 @@ import pika
 import json
 from flask import Flask, jsonify, request
 from utils.supabase import get_supabase
+from cart_store import CartStore, EMPTY_TOTALS, BATCH_OPS, CREATED, CART_NOT_FOUND, PRODUCT_NOT_FOUND, AT_FLOOR, REJECTED
 import utils.amqp_lib as rabbit
+from utils.invokes import invoke_http_async
 import time
 from utils.cors_config import enable_cors
 
 supabase = get_supabase()
+cart_store = CartStore(supabase)
 
 RABBITMQ_HOST = "rabbitmq"
 RABBITMQ_PORT = 5672
@@ -15,9 +18,25 @@ RABBITMQ_PORT = 5672
 CART_QUEUE_NAME = "cart_queue"
 PLACE_ORDER_EXCHANGE_NAME = "place_order_exchange"
 
+# Recommendations exclude cart items, so they are recomputed whenever the cart changes
+RECOMMENDATION_CACHE_URL = "http://recommendation:5204/recommendations/cache/{user_id}"
+
+# cart_product holds stock for cart contents until the cart is cleared
+RESERVATION_RELEASE_URL = "http://cart_product:5300/cart-product/release"
+
 app = Flask(__name__)
 enable_cors(app)
 
+def invalidate_recommendations(user_id):
+    """ Drops the user's cached recommendations without waiting for the response """
+    invoke_http_async(RECOMMENDATION_CACHE_URL.format(user_id=user_id), "DELETE", retries=0)
+
+
+def totals_fields(totals):
+    """ Response fields for the cart's stored running totals (subtotal kept in exact cents) """
+    return {"total_price": totals["subtotal_cents"] / 100, "totals": totals}
+
+
 @app.route('/cart/add', methods=['POST'])
 def add_to_cart():
     data = request.json
@@ -35,23 +54,12 @@ def add_to_cart():
     product["quantity"] = quantity
 
     try:
-        response = supabase.table("carts").select("*").eq("user_id", user_id).execute()
-        if not response.data:
-            new_cart = {str(product_id): product}
-            supabase.table("carts").insert({"user_id": user_id, "cart": new_cart}).execute()
-            return jsonify({"code": 200, "message": "Cart created", "cart": new_cart}), 200
-        else:
-            existing_cart = response.data[0].get("cart", {})
-            existing_product = existing_cart.get(str(product_id))
-
-            if existing_product:
-                product["quantity"] = existing_product.get("quantity", 0) + quantity
+        status, cart, totals = cart_store.add_item(user_id, product, quantity)
+        invalidate_recommendations(user_id)
+        if status == CREATED:
+            return jsonify({"code": 200, "message": "Cart created", "cart": cart, **totals_fields(totals)}), 200
 
-            existing_cart[str(product_id)] = product
-            supabase.table("carts").update({"cart": existing_cart}).eq("user_id", user_id).execute()
-
-            total_price = sum(item["quantity"] * item["Price"] for item in existing_cart.values())
-            return jsonify({"code": 200, "message": "Cart updated", "cart": existing_cart, "total_price": total_price}), 200
+        return jsonify({"code": 200, "message": "Cart updated", "cart": cart, **totals_fields(totals)}), 200
 
     except Exception as e:
         return jsonify({"code": 500, "error": str(e)}), 500
@@ -68,26 +76,16 @@ def decrement_quantity():
         return jsonify({"code": 400, "error": "Invalid productId"}), 400
 
     try:
-        response = supabase.table("carts").select("*").eq("user_id", user_id).execute()
+        status, cart, totals = cart_store.decrement_item(user_id, product_id, floor=1)
 
-        if not response.data:
+        if status == CART_NOT_FOUND:
             return jsonify({"code": 404, "error": "Cart not found"}), 404
-
-        cart = response.data[0]["cart"]
-
-        if str(product_id) not in cart:
+        if status == PRODUCT_NOT_FOUND:
             return jsonify({"code": 404, "error": "Product not found in cart"}), 404
-
-        current_quantity = cart[str(product_id)]["quantity"]
-        if current_quantity > 1:
-            cart[str(product_id)]["quantity"] = current_quantity - 1
-        else:
+        if status == AT_FLOOR:
             return jsonify({"code": 400, "error": "Cannot decrement below 1"}), 400
 
-        supabase.table("carts").update({"cart": cart}).eq("user_id", user_id).execute()
-
-        total_price = sum(item["quantity"] * item["Price"] for item in cart.values())
-        return jsonify({"code": 200, "message": "Quantity decremented", "cart": cart, "total_price": total_price}), 200
+        return jsonify({"code": 200, "message": "Quantity decremented", "cart": cart, **totals_fields(totals)}), 200
 
     except Exception as e:
         return jsonify({"code": 500, "error": str(e)}), 500
@@ -105,35 +103,84 @@ def decrement_cart():
         return jsonify({"code": 400, "error": "Invalid productId"}), 400
 
     try:
-        response = (supabase.table("carts")
-            .select("*")
-            .eq("user_id", user_id)
-            .execute()
-        )
-        cart = response.data[0]["cart"]
-        print(cart)
-
-        if str(product_id) not in cart:
+        status, cart, totals = cart_store.remove_item(user_id, product_id)
+
+        if status == CART_NOT_FOUND:
+            return jsonify({"code": 404, "error": "Cart not found"}), 404
+        if status == PRODUCT_NOT_FOUND:
             print(str(product_id), cart)
             return jsonify({"code": 404, "error": "Product not found in cart"}), 404
-        
-        del cart[str(product_id)]
-
-        try:
-            response = (
-                supabase.table("carts")
-                .update({"cart": cart})
-                .eq("user_id", user_id)
-                .execute()
-            )
 
-            return jsonify({"code": 200, "message": "Product removed successfully", "cart": cart, "response" : response.data}), 200
-        except Exception as e:
-            return {"error": "Couldn't update removed cart", "message": str(e)}, 404
+        invalidate_recommendations(user_id)
+        return jsonify({"code": 200, "message": "Product removed successfully", "cart": cart, **totals_fields(totals)}), 200
 
     except Exception as e:
-        return {"error" : "Couldn't get user's cart", "message":str(e)}, 500
+        return {"error": "Couldn't update removed cart", "message": str(e)}, 500
+
+
 
+def validate_operation(operation):
+    """ Returns an error message for an invalid batch operation, or None """
+    op = operation.get("op") if isinstance(operation, dict) else None
+    if op not in BATCH_OPS:
+        return f"op must be one of {', '.join(BATCH_OPS)}"
+
+    product = operation.get("product")
+    if op == "add" or (op == "set" and product is not None):
+        if not isinstance(product, dict):
+            return "product is required"
+        product_id = product.get("productId")
+    else:
+        product_id = operation.get("productId")
+    if not isinstance(product_id, int) or product_id <= 0:
+        return "Invalid productId"
+
+    if op in ("add", "set"):
+        quantity = operation.get("quantity")
+        if not isinstance(quantity, int) or quantity < 0:
+            return "Quantity must be a positive integer"
+    return None
+
+
+@app.route('/cart/<user_id>/batch', methods=['POST'])
+def apply_cart_batch(user_id):
+    """
+    Applies several line changes in one write. All operations are validated first,
+    and either all of them are applied or none are.
+    Body: {"operations": [{"op": "add", "product": {...}, "quantity": 2},
+                          {"op": "set", "productId": 12, "quantity": 3},
+                          {"op": "decrement", "productId": 12},
+                          {"op": "remove", "productId": 7}]}
+    """
+    operations = (request.json or {}).get("operations")
+    if not isinstance(operations, list) or not operations:
+        return jsonify({"code": 400, "error": "operations must be a non-empty list"}), 400
+
+    errors = []
+    for index, operation in enumerate(operations):
+        error = validate_operation(operation)
+        if error:
+            errors.append({"index": index, "error": error})
+    if errors:
+        return jsonify({"code": 400, "error": "Invalid operations", "details": errors}), 400
+
+    for operation in operations:
+        if operation.get("product"):
+            operation["product"] = {key: value for key, value in operation["product"].items() if key not in ("Stock", "quantity")}
+
+    try:
+        status, cart, totals, error = cart_store.apply_batch(user_id, operations)
+        if status == REJECTED:
+            reason = "Cannot decrement below 1" if error["reason"] == AT_FLOOR else "Product not found in cart"
+            return jsonify({"code": 409, "error": reason, "details": [error], "cart": cart or {}, **totals_fields(totals)}), 409
+
+        if any(operation["op"] != "decrement" for operation in operations):
+            invalidate_recommendations(user_id)
+        message = "Cart created" if status == CREATED else "Cart updated"
+        return jsonify({"code": 200, "message": message, "cart": cart, **totals_fields(totals)}), 200
+
+    except Exception as e:
+        return jsonify({"code": 500, "error": str(e)}), 500
 
 
 @app.route('/cart/<user_id>', methods=['GET'])
@@ -142,20 +189,13 @@ def view_cart(user_id):
     print("====== GETTING USER'S CART INFO ======")
     print(user_id)
     try:
-        response = (
-            supabase.table("carts")
-            .select("*")
-            .eq("user_id", user_id)
-            .execute()
-        )
-
-        if not response.data:
+        cart_items, totals = cart_store.get(user_id)
+
+        if cart_items is None:
             # No cart found for user — return empty cart
-            return jsonify({"code": 200, "cart": {}, "total_price": 0}), 200
+            return jsonify({"code": 200, "cart": {}, **totals_fields(EMPTY_TOTALS)}), 200
 
-        cart_items = response.data[0]["cart"]
-        total_price = sum(item["quantity"] * item["Price"] for item in cart_items.values())
-        return jsonify({"code": 200, "cart": cart_items, "total_price": total_price}), 200
+        return jsonify({"code": 200, "cart": cart_items, **totals_fields(totals)}), 200
 
     except Exception as e:
         return {"error" : "Failed to retrieve cart", "message" : str(e)}, 500
@@ -174,13 +214,10 @@ def clear_cart(user_id):
 def clear_user_cart(user_id):
     """ Clear all items from cart in Supabase """
     try:
-        response = (
-            supabase.table("carts")
-            .delete()
-            .eq("user_id", user_id)
-            .execute()
-        )
+        cart_store.clear(user_id)
         print(f"Cart cleared for user {user_id}.")
+        invalidate_recommendations(user_id)
+        invoke_http_async(RESERVATION_RELEASE_URL, "POST", json={"userID": user_id})
     except Exception as e:
         print(f"Error clearing cart for user {user_id}: {str(e)}")
 
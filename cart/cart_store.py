@@ -0,0 +1,178 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+from utils.supabase import get_supabase
+
+# Outcomes reported by the cart functions in cart_store.sql
+CREATED = "created"
+UPDATED = "updated"
+CART_NOT_FOUND = "cart_not_found"
+PRODUCT_NOT_FOUND = "product_not_found"
+AT_FLOOR = "at_floor"
+REJECTED = "rejected"
+
+# Operations accepted by apply_batch
+BATCH_OPS = ("add", "set", "decrement", "remove")
+
+# Carts kept in memory (LRU). Every cart write goes through this service, so the cache
+# is write-through; the TTL only bounds staleness if the table is edited elsewhere.
+CART_CACHE_SIZE = 10000
+CART_CACHE_TTL = 300
+
+# Totals stored next to each cart by cart_store.sql (money in integer cents)
+EMPTY_TOTALS = {"subtotal_cents": 0, "item_count": 0, "sustainability_points": 0}
+
+_NO_CART = object()
+_INVALID = object()
+
+
+class CartStore:
+    """
+    Storage for carts.cart documents ({productId: product with quantity}).
+
+    Line changes go through the Postgres functions in cart_store.sql, so each one
+    is a single atomic round trip instead of a read-modify-write of the whole cart.
+    Mutations return (status, cart, totals) with the cart and its running totals
+    as stored after the change.
+
+    Carts read or written are kept in an LRU cache keyed by user_id (including
+    users without a cart), and every mutation writes its result through to it.
+    Results can finish in a different order than they committed, so each carries
+    the cart's version and never replaces a cached entry with an older one.
+    invalidate() leaves a tombstone, so calls already in flight when it ran
+    can't repopulate the cache either. Callers always get copies.
+    """
+
+    def __init__(self, supabase=None, cache_size=CART_CACHE_SIZE, cache_ttl=CART_CACHE_TTL):
+        self.supabase = supabase or get_supabase()
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        # str(user_id) -> (value, version, stored_at, seq), value being (cart, totals), _NO_CART or _INVALID
+        self._cache = OrderedDict()
+        self._seq = 0  # bumped by every invalidate
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """ Returns (cart, totals), with cart None if the user doesn't have one """
+        cached = self._cached(user_id)
+        if cached is not None:
+            return (None, dict(EMPTY_TOTALS)) if cached is _NO_CART else copy.deepcopy(cached)
+
+        started = self._seq
+        response = (
+            self.supabase.table("carts")
+            .select("cart, subtotal_cents, item_count, sustainability_points, version")
+            .eq("user_id", user_id)
+            .execute()
+        )
+        if not response.data:
+            self._store(user_id, None, None, None, started)
+            return None, dict(EMPTY_TOTALS)
+
+        row = response.data[0]
+        cart = row["cart"]
+        totals = {key: row[key] for key in EMPTY_TOTALS}
+        self._store(user_id, cart, totals, row["version"], started)
+        return copy.deepcopy(cart), totals
+
+    def add_item(self, user_id, product, quantity):
+        """ Adds quantity of product, creating the cart or line if needed """
+        return self._call("cart_add_item", {
+            "p_user_id": user_id,
+            "p_product_id": str(product["productId"]),
+            "p_product": product,
+            "p_quantity": quantity
+        })
+
+    def decrement_item(self, user_id, product_id, floor=1):
+        """ Decrements a line by 1, refusing (AT_FLOOR) once it is at floor """
+        return self._call("cart_decrement_item", {"p_user_id": user_id, "p_product_id": str(product_id), "p_floor": floor})
+
+    def remove_item(self, user_id, product_id):
+        return self._call("cart_remove_item", {"p_user_id": user_id, "p_product_id": str(product_id)})
+
+    def apply_batch(self, user_id, operations):
+        """
+        Applies operations (see cart_apply_batch in cart_store.sql) in order with
+        a single write. Returns (status, cart, totals, error); if any operation
+        can't be applied the status is REJECTED, nothing is written and error
+        says which operation failed and why.
+        """
+        result = self._rpc("cart_apply_batch", {"p_user_id": user_id, "p_ops": operations})
+        return result["status"], copy.deepcopy(result.get("cart")), dict(result["totals"]), result.get("error")
+
+    def clear(self, user_id):
+        started = self._seq
+        try:
+            version = self.supabase.rpc("cart_clear", {"p_user_id": user_id}).execute().data
+        except Exception:
+            self.invalidate(user_id)
+            raise
+        self._store(user_id, None, None, version, started)
+
+    def invalidate(self, user_id):
+        """ Drops a cached cart, including results of calls still in flight """
+        with self._lock:
+            self._seq += 1
+            self._put(str(user_id), (_INVALID, None, time.monotonic(), self._seq))
+
+    def _call(self, function, params):
+        result = self._rpc(function, params)
+        return result["status"], copy.deepcopy(result.get("cart")), dict(result["totals"])
+
+    def _rpc(self, function, params):
+        """ Calls a cart function and writes the cart it returns through to the cache """
+        user_id = params["p_user_id"]
+        started = self._seq
+        try:
+            result = self.supabase.rpc(function, params).execute().data
+        except Exception:
+            # The write may or may not have happened, so don't trust the cached copy
+            self.invalidate(user_id)
+            raise
+        result.setdefault("totals", dict(EMPTY_TOTALS))
+        if result["status"] == CART_NOT_FOUND or (result["status"] == REJECTED and not result.get("cart")):
+            self._store(user_id, None, None, None, started)
+        elif result.get("cart") is not None:
+            self._store(user_id, result["cart"], result["totals"], result.get("version"), started)
+        return result
+
+    def _cached(self, user_id):
+        key = str(user_id)
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None or entry[0] is _INVALID:
+                return None
+            if time.monotonic() - entry[2] >= self.cache_ttl:
+                del self._cache[key]
+                return None
+            self._cache.move_to_end(key)
+            return entry[0]
+
+    def _store(self, user_id, cart, totals, version, started):
+        """
+        Caches the result of a read or write that began when the invalidation
+        sequence was at started. version is the cart's version in the database,
+        or None when the result carries none (no cart row).
+        """
+        key = str(user_id)
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and time.monotonic() - entry[2] < self.cache_ttl:
+                cached_value, cached_version, _, cached_seq = entry
+                if cached_seq > started:
+                    # Invalidated after this call began; its result may predate the write that failed
+                    return
+                if cached_value is not _INVALID:
+                    if version is None or (cached_version is not None and version <= cached_version):
+                        # Not newer than what's cached (results can finish out of commit order)
+                        return
+            value = _NO_CART if cart is None else (copy.deepcopy(cart), dict(totals))
+            self._put(key, (value, version, time.monotonic(), self._seq))
+
+    def _put(self, key, entry):
+        self._cache[key] = entry
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
@@ -0,0 +1,240 @@
+-- Atomic cart operations used by cart/cart_store.py (run once in the Supabase SQL editor).
+-- Each function changes one line of carts.cart in a single round trip, with the row
+-- locked, so concurrent writers never overwrite each other's changes. carts.user_id
+-- must be unique.
+--
+-- Cart totals are stored next to the document and adjusted by the difference between
+-- the old and new line on every change, so they never have to be recomputed. Money is
+-- kept in integer cents.
+--
+-- Every write stamps the cart with a new version from cart_version_seq (a sequence rather
+-- than a per-row counter, so versions keep increasing when a cart is cleared and
+-- recreated). cart_store.py only caches a result newer than the one it already holds.
+
+-- Skip this if user_id is already the primary key or unique
+alter table carts add constraint carts_user_id_key unique (user_id);
+
+alter table carts
+    add column if not exists subtotal_cents bigint not null default 0,
+    add column if not exists item_count integer not null default 0,
+    add column if not exists sustainability_points bigint not null default 0;
+
+create sequence if not exists cart_version_seq;
+alter table carts add column if not exists version bigint not null default 0;
+
+-- Line value in cents / sustainability points (0 for a missing line)
+create or replace function cart_line_cents(p_line jsonb)
+returns bigint language sql immutable as $$
+    select coalesce(round((p_line ->> 'Price')::numeric * 100)::bigint * (p_line ->> 'quantity')::int, 0);
+$$;
+
+create or replace function cart_line_points(p_line jsonb)
+returns bigint language sql immutable as $$
+    select coalesce(round((p_line ->> 'SustainabilityPoints')::numeric)::bigint * (p_line ->> 'quantity')::int, 0);
+$$;
+
+-- Backfill totals for carts created before the columns existed
+update carts c
+   set subtotal_cents = t.subtotal_cents,
+       item_count = t.item_count,
+       sustainability_points = t.sustainability_points
+  from (
+      select user_id,
+             sum(cart_line_cents(line.value)) as subtotal_cents,
+             sum((line.value ->> 'quantity')::int) as item_count,
+             sum(cart_line_points(line.value)) as sustainability_points
+        from carts, jsonb_each(cart) as line
+       group by user_id
+  ) t
+ where c.user_id = t.user_id;
+
+-- Result shape shared by the functions below
+create or replace function cart_result(p_status text, p_row carts)
+returns jsonb language sql immutable as $$
+    select jsonb_build_object(
+        'status', p_status,
+        'cart', p_row.cart,
+        'version', p_row.version,
+        'totals', jsonb_build_object(
+            'subtotal_cents', p_row.subtotal_cents,
+            'item_count', p_row.item_count,
+            'sustainability_points', p_row.sustainability_points
+        )
+    );
+$$;
+
+-- Replaces one line (p_new null removes it) and applies the difference to the totals
+create or replace function cart_set_line(p_user_id carts.user_id%type, p_product_id text, p_old jsonb, p_new jsonb)
+returns carts language sql as $$
+    update carts
+       set cart = case when p_new is null then cart - p_product_id else cart || jsonb_build_object(p_product_id, p_new) end,
+           subtotal_cents = subtotal_cents + cart_line_cents(p_new) - cart_line_cents(p_old),
+           item_count = item_count + coalesce((p_new ->> 'quantity')::int, 0) - coalesce((p_old ->> 'quantity')::int, 0),
+           sustainability_points = sustainability_points + cart_line_points(p_new) - cart_line_points(p_old),
+           version = nextval('cart_version_seq')
+     where user_id = p_user_id
+    returning *;
+$$;
+
+-- Adds quantity of a product, creating the cart or line if needed
+create or replace function cart_add_item(p_user_id carts.user_id%type, p_product_id text, p_product jsonb, p_quantity int)
+returns jsonb language plpgsql as $$
+declare
+    v_created boolean;
+    v_old jsonb;
+    v_row carts;
+begin
+    insert into carts (user_id, cart) values (p_user_id, '{}'::jsonb) on conflict (user_id) do nothing;
+    v_created := found;
+
+    select cart -> p_product_id into v_old from carts where user_id = p_user_id for update;
+    v_row := cart_set_line(
+        p_user_id, p_product_id, v_old,
+        p_product || jsonb_build_object('quantity', coalesce((v_old ->> 'quantity')::int, 0) + p_quantity)
+    );
+    return cart_result(case when v_created then 'created' else 'updated' end, v_row);
+end;
+$$;
+
+-- Decrements a line by 1 unless it is already at p_floor
+create or replace function cart_decrement_item(p_user_id carts.user_id%type, p_product_id text, p_floor int default 1)
+returns jsonb language plpgsql as $$
+declare
+    v_row carts;
+    v_old jsonb;
+begin
+    select * into v_row from carts where user_id = p_user_id for update;
+    if not found then
+        return jsonb_build_object('status', 'cart_not_found');
+    end if;
+
+    v_old := v_row.cart -> p_product_id;
+    if v_old is null then
+        return cart_result('product_not_found', v_row);
+    elsif (v_old ->> 'quantity')::int <= p_floor then
+        return cart_result('at_floor', v_row);
+    end if;
+
+    v_row := cart_set_line(p_user_id, p_product_id, v_old, jsonb_set(v_old, '{quantity}', to_jsonb((v_old ->> 'quantity')::int - 1)));
+    return cart_result('updated', v_row);
+end;
+$$;
+
+-- Removes a line from the cart
+create or replace function cart_remove_item(p_user_id carts.user_id%type, p_product_id text)
+returns jsonb language plpgsql as $$
+declare
+    v_row carts;
+    v_old jsonb;
+begin
+    select * into v_row from carts where user_id = p_user_id for update;
+    if not found then
+        return jsonb_build_object('status', 'cart_not_found');
+    end if;
+
+    v_old := v_row.cart -> p_product_id;
+    if v_old is null then
+        return cart_result('product_not_found', v_row);
+    end if;
+
+    v_row := cart_set_line(p_user_id, p_product_id, v_old, null);
+    return cart_result('updated', v_row);
+end;
+$$;
+
+-- Applies a list of line operations in order, with one write at the end. Operations:
+--   {"op": "add", "product": {...}, "quantity": n}
+--   {"op": "set", "productId": id, "quantity": n}  (or "product" to create the line; 0 removes it)
+--   {"op": "decrement", "productId": id}            (stops at 1)
+--   {"op": "remove", "productId": id}
+-- If any operation can't be applied nothing is written and the result is
+-- {"status": "rejected", "error": {"index": i, "reason": ...}} with the unchanged cart.
+create or replace function cart_apply_batch(p_user_id carts.user_id%type, p_ops jsonb)
+returns jsonb language plpgsql as $$
+declare
+    v_created boolean;
+    v_row carts;
+    v_cart jsonb;
+    v_op jsonb;
+    v_index int := 0;
+    v_id text;
+    v_old jsonb;
+    v_new jsonb;
+    v_reason text;
+    v_cents bigint := 0;
+    v_items int := 0;
+    v_points bigint := 0;
+begin
+    insert into carts (user_id, cart) values (p_user_id, '{}'::jsonb) on conflict (user_id) do nothing;
+    v_created := found;
+
+    select * into v_row from carts where user_id = p_user_id for update;
+    v_cart := v_row.cart;
+
+    for v_op in select value from jsonb_array_elements(p_ops) loop
+        v_id := coalesce(v_op -> 'product' ->> 'productId', v_op ->> 'productId');
+        v_old := v_cart -> v_id;
+        v_reason := null;
+
+        case v_op ->> 'op'
+            when 'add' then
+                v_new := (v_op -> 'product') || jsonb_build_object('quantity', coalesce((v_old ->> 'quantity')::int, 0) + (v_op ->> 'quantity')::int);
+            when 'set' then
+                if (v_op ->> 'quantity')::int = 0 then
+                    v_new := null;
+                elsif v_old is null and v_op -> 'product' is null then
+                    v_reason := 'product_not_found';
+                else
+                    v_new := coalesce(v_op -> 'product', v_old) || jsonb_build_object('quantity', (v_op ->> 'quantity')::int);
+                end if;
+            when 'decrement' then
+                if v_old is null then
+                    v_reason := 'product_not_found';
+                elsif (v_old ->> 'quantity')::int <= 1 then
+                    v_reason := 'at_floor';
+                else
+                    v_new := jsonb_set(v_old, '{quantity}', to_jsonb((v_old ->> 'quantity')::int - 1));
+                end if;
+            when 'remove' then
+                if v_old is null then
+                    v_reason := 'product_not_found';
+                else
+                    v_new := null;
+                end if;
+            else
+                v_reason := 'unknown_op';
+        end case;
+
+        if v_reason is not null then
+            if v_created then
+                delete from carts where user_id = p_user_id;
+                v_row.cart := '{}'::jsonb;
+            end if;
+            return cart_result('rejected', v_row) || jsonb_build_object('error', jsonb_build_object('index', v_index, 'reason', v_reason));
+        end if;
+
+        v_cents := v_cents + cart_line_cents(v_new) - cart_line_cents(v_old);
+        v_items := v_items + coalesce((v_new ->> 'quantity')::int, 0) - coalesce((v_old ->> 'quantity')::int, 0);
+        v_points := v_points + cart_line_points(v_new) - cart_line_points(v_old);
+        v_cart := case when v_new is null then v_cart - v_id else v_cart || jsonb_build_object(v_id, v_new) end;
+        v_index := v_index + 1;
+    end loop;
+
+    update carts
+       set cart = v_cart,
+           subtotal_cents = subtotal_cents + v_cents,
+           item_count = item_count + v_items,
+           sustainability_points = sustainability_points + v_points,
+           version = nextval('cart_version_seq')
+     where user_id = p_user_id
+    returning * into v_row;
+    return cart_result(case when v_created then 'created' else 'updated' end, v_row);
+end;
+$$;
+
+-- Deletes the cart, returning the version the deletion is stamped with
+create or replace function cart_clear(p_user_id carts.user_id%type)
+returns bigint language sql as $$
+    delete from carts where user_id = p_user_id;
+    select nextval('cart_version_seq');
+$$;
@@ -1,16 +1,20 @@
 import os
 import sys
 from flask import Flask, request, jsonify
-from utils.invokes import invoke_http
+from utils.invokes import invoke_http, invoke_http_async
+from utils.product_cache import get_catalogue
+from reservations import get_ledger, request_stock_sync
 from utils.cors_config import enable_cors
 
 app = Flask(__name__)
 enable_cors(app)
 
 # Microservice URLs
-PRODUCT_SERVICE_URL = "https://personal-o2kymv2n.outsystemscloud.com/SustainaMart/rest/v1/products/{}"
 CART_SERVICE_URL = "http://cart:5201/cart"
 
+# Operations accepted by /cart-product/batch (same as the cart service's batch endpoint)
+BATCH_OPS = ("add", "set", "decrement", "remove")
+
 @app.route("/cart-product/add", methods=['POST'])
 def add_to_cart():
     """ Handles adding an item to the cart (increment behavior) """
@@ -26,32 +30,38 @@ def add_to_cart():
         if not isinstance(quantity, int) or quantity <= 0:
             return jsonify({"code": 400, "error": "Quantity must be a positive integer"}), 400
 
-        # Step 1: Get user's current cart to determine existing quantity
-        cart_response = invoke_http(f"{CART_SERVICE_URL}/{userID}", method="GET")
+        # Step 1: Get user's current cart (for the existing quantity) while the
+        # product details are read from the catalogue cache
+        cart_future = invoke_http_async(f"{CART_SERVICE_URL}/{userID}", method="GET")
+
+        # Step 2: Fetch product details from the cache; stock is checked against the ledger,
+        # which the background sync keeps up to date
+        product = get_catalogue().get(product_id)
+
+        print(f"Product details: {product}")  
+
+        cart_response = cart_future.result()
         if "error" in cart_response:
             current_quantity = 0
         else:
             current_quantity = cart_response.get("cart", {}).get(str(product_id), {}).get("quantity", 0)
 
-        # Step 2: Fetch product details from Product Microservice
-        product_response = invoke_http(PRODUCT_SERVICE_URL.format(product_id), method="GET")
-
-        print(f"Product API Response: {product_response}")  
-
-        if not product_response or not product_response.get("Result", {}).get("Success"):
-            return jsonify({"code": 404, "error": "Product not found"}), 404
-
-        product = product_response.get("Product")
         if not product:
-            return jsonify({"code": 404, "error": "Product data not found"}), 404
+            return jsonify({"code": 404, "error": "Product not found"}), 404
 
-        stock = product.get("Stock")
+        # Hold the cart's full quantity of this product (replacing the previous hold)
+        ledger = get_ledger()
         new_quantity = current_quantity + quantity
+        short = ledger.reserve(userID, {product_id: new_quantity})
 
-        if new_quantity > stock:
+        if short:
+            available = short[0]["available"]
+            if available is None:
+                request_stock_sync()
+                return jsonify({"code": 503, "error": "Stock for this product is unavailable, please try again"}), 503
             return jsonify({
                 "code": 400,
-                "error": f"Not enough stock. Current in cart: {current_quantity}, Available: {stock - current_quantity}"
+                "error": f"Not enough stock. Current in cart: {current_quantity}, Available: {available - current_quantity}"
             }), 400
 
         # Step 3: Prepare payload for cart microservice
@@ -64,6 +74,9 @@ def add_to_cart():
 
         # Step 4: Forward to Cart Microservice
         cart_response = invoke_http(f"{CART_SERVICE_URL}/add", method="POST", json=cart_payload)
+        if cart_response.get("code") != 200:
+            # Put the hold back to what the cart still contains
+            ledger.reserve(userID, {product_id: current_quantity})
         print("==============ADDED TO CART==============")
         return jsonify(cart_response), cart_response.get("code", 500)
 
@@ -105,7 +118,10 @@ def decrement_cart_product():
             "productId": product_id,
             "user_id": user_id
         }
-        response = invoke_http(f"{CART_SERVICE_URL}/decrement", method="PUT", json=decrement_payload)
+        response = invoke_http(f"{CART_SERVICE_URL}/decrement", method="PUT", json=decrement_payload, retries=0)
+        if response.get("code") == 200:
+            # Shrinking a hold always fits
+            get_ledger().reserve(user_id, {product_id: response["cart"][str(product_id)]["quantity"]})
         return jsonify(response), response.get("code", 500)
 
     except Exception as e:
@@ -134,6 +150,103 @@ def remove_from_cart():
 
         # Forward the request to Cart Microservice
         cart_response = invoke_http(f"{CART_SERVICE_URL}/remove", method="PUT", json={"productId": product_id, "user_id": user_id})
+        if cart_response.get("code") == 200:
+            get_ledger().release(user_id, [product_id])
+        return jsonify(cart_response), cart_response.get("code", 500)
+
+    except Exception as e:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
+        error_message = f"{str(e)} at {exc_type}: {fname}: line {exc_tb.tb_lineno}"
+        print(error_message)
+
+        return jsonify({
+            "code": 500,
+            "message": "Internal error in cart-product service",
+            "error": error_message
+        }), 500
+
+
+@app.route("/cart-product/batch", methods=['POST'])
+def batch_update_cart():
+    """
+    Applies several cart changes at once (e.g. restoring a basket or reordering).
+    Stock for every product being added is checked in one pass and the changes
+    are forwarded to the cart service as a single batch.
+    Body: {"userID": 1, "operations": [{"op": "add", "productId": 12, "quantity": 2},
+                                       {"op": "set", "productId": 7, "quantity": 1},
+                                       {"op": "decrement", "productId": 3},
+                                       {"op": "remove", "productId": 5}]}
+    """
+    try:
+        data = request.json
+        userID = data.get("userID")
+        operations = data.get("operations")
+
+        if not isinstance(operations, list) or not operations:
+            return jsonify({"code": 400, "error": "operations must be a non-empty list"}), 400
+
+        for operation in operations:
+            if not isinstance(operation, dict) or operation.get("op") not in BATCH_OPS:
+                return jsonify({"code": 400, "error": f"op must be one of {', '.join(BATCH_OPS)}"}), 400
+            product_id = operation.get("productId")
+            if not isinstance(product_id, int) or product_id <= 0:
+                return jsonify({"code": 400, "error": "Invalid productId"}), 400
+            if operation["op"] == "add":
+                operation.setdefault("quantity", 1)
+                if not isinstance(operation["quantity"], int) or operation["quantity"] <= 0:
+                    return jsonify({"code": 400, "error": "Quantity must be a positive integer"}), 400
+            if operation["op"] == "set" and (not isinstance(operation.get("quantity"), int) or operation["quantity"] < 0):
+                return jsonify({"code": 400, "error": "Quantity must be a positive integer"}), 400
+
+        # Step 1: Get user's current cart while the products being added are looked up together
+        cart_future = invoke_http_async(f"{CART_SERVICE_URL}/{userID}", method="GET")
+
+        stock_ids = {operation["productId"] for operation in operations if operation["op"] in ("add", "set") and operation["quantity"] > 0}
+        products = get_catalogue().get_many(stock_ids)
+
+        missing = sorted(stock_ids - set(products))
+        if missing:
+            return jsonify({"code": 404, "error": "Product not found", "productIds": missing}), 404
+
+        cart_response = cart_future.result()
+        cart = {} if "error" in cart_response else cart_response.get("cart", {})
+
+        # Step 2: Work out the final quantity of each product and hold it against stock
+        quantities = {}
+        for operation in operations:
+            product_id = operation["productId"]
+            current_quantity = quantities.get(product_id, cart.get(str(product_id), {}).get("quantity", 0))
+            if operation["op"] == "add":
+                quantities[product_id] = current_quantity + operation["quantity"]
+            elif operation["op"] == "set":
+                quantities[product_id] = operation["quantity"]
+            elif operation["op"] == "decrement":
+                quantities[product_id] = max(current_quantity - 1, 1)
+            else:
+                quantities[product_id] = 0
+
+        ledger = get_ledger()
+        short = ledger.reserve(userID, quantities)
+        if short:
+            if any(item["available"] is None for item in short):
+                request_stock_sync()
+                return jsonify({"code": 503, "error": "Stock is unavailable for some products, please try again", "details": short}), 503
+            return jsonify({"code": 400, "error": "Not enough stock", "details": short}), 400
+
+        # Step 3: Forward every change to the cart microservice in one call
+        cart_operations = []
+        for operation in operations:
+            product_id = operation["productId"]
+            if operation["op"] in ("add", "set") and product_id in products:
+                cart_operations.append({"op": operation["op"], "product": products[product_id], "quantity": operation["quantity"]})
+            else:
+                cart_operations.append({key: value for key, value in operation.items() if key in ("op", "productId", "quantity")})
+
+        cart_response = invoke_http(f"{CART_SERVICE_URL}/{userID}/batch", method="POST", json={"operations": cart_operations})
+        if cart_response.get("code") != 200:
+            # Nothing was applied, so put the holds back to what the cart still contains
+            ledger.reserve(userID, {product_id: cart.get(str(product_id), {}).get("quantity", 0) for product_id in quantities})
         return jsonify(cart_response), cart_response.get("code", 500)
 
     except Exception as e:
@@ -149,5 +262,21 @@ def remove_from_cart():
         }), 500
 
 
+@app.route("/cart-product/release", methods=['POST'])
+def release_reservations():
+    """ Releases a user's stock holds (called when their cart is cleared or checkout expires) """
+    user_id = (request.json or {}).get("userID")
+    if user_id is None:
+        return jsonify({"code": 400, "error": "userID is required"}), 400
+
+    get_ledger().release(user_id)
+    return jsonify({"code": 200, "message": "Reservations released"}), 200
+
+
+@app.route("/cart-product/reservations", methods=['GET'])
+def reservation_stats():
+    return jsonify({"code": 200, **get_ledger().stats()}), 200
+
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5300, debug=True)
@@ -0,0 +1,168 @@
+import heapq
+import threading
+import time
+import logging
+from utils.product_cache import get_catalogue
+
+# How long a cart's hold on stock lasts without being renewed by another cart change
+HOLD_TTL = 900
+
+# How often upstream stock is re-read from the product API
+STOCK_SYNC_INTERVAL = 60
+
+
+class ReservationLedger:
+    """
+    In-memory stock reservations for carts.
+
+    Each user holds a quantity of each product in their cart, and a product's
+    reserved count is the sum of its live holds. A hold is accepted only if the
+    upstream stock minus everyone else's holds covers it, so concurrent shoppers
+    can't put more of an item in their carts than exists. Holds expire after
+    hold_ttl seconds unless renewed, and are released when a cart is cleared.
+    """
+
+    def __init__(self, hold_ttl=HOLD_TTL):
+        self.hold_ttl = hold_ttl
+        self._stock = {}  # productId -> upstream stock
+        self._reserved = {}  # productId -> sum of live holds
+        self._holds = {}  # user_id -> {productId: (quantity, expires_at)}
+        self._expiries = []  # heap of (expires_at, user_id, productId)
+        self._lock = threading.Lock()
+
+    def apply(self, upserted, removed):
+        """
+        Catalogue listener: keeps upstream stock in step with the product cache.
+        """
+        with self._lock:
+            for product_id in removed:
+                self._stock.pop(int(product_id), None)
+            for product in upserted:
+                stock = product.get("Stock")
+                if stock is not None:
+                    self._stock[int(product["productId"])] = int(stock)
+
+    def available(self, product_id, user_id=None):
+        """ Stock left for user_id (counting what they already hold), or None if unknown """
+        with self._lock:
+            self._expire(time.monotonic())
+            return self._available(int(product_id), str(user_id))
+
+    def reserve(self, user_id, quantities):
+        """
+        Sets the user's holds to {productId: total quantity in cart} (0 releases a
+        product), renewing their expiry. All-or-nothing: returns [] on success, or
+        a list of {productId, requested, available} for the products that don't fit.
+        A hold can't grow on a product whose stock isn't known (available is None
+        in the result), so a failed stock sync never turns oversell protection off;
+        shrinking a hold always fits.
+        """
+        user_id = str(user_id)
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            short = []
+            for product_id, quantity in quantities.items():
+                product_id = int(product_id)
+                if quantity <= self._held(product_id, user_id):
+                    continue
+                available = self._available(product_id, user_id)
+                if available is None or quantity > available:
+                    short.append({"productId": product_id, "requested": quantity, "available": available})
+            if short:
+                return short
+
+            expires_at = now + self.hold_ttl
+            for product_id, quantity in quantities.items():
+                self._set_hold(user_id, int(product_id), quantity, expires_at)
+            return []
+
+    def release(self, user_id, product_ids=None):
+        """ Drops the user's holds on product_ids, or all of them """
+        user_id = str(user_id)
+        with self._lock:
+            held = self._holds.get(user_id, {})
+            for product_id in list(held if product_ids is None else map(int, product_ids)):
+                self._set_hold(user_id, product_id, 0, None)
+
+    def stats(self):
+        with self._lock:
+            self._expire(time.monotonic())
+            return {
+                "products": len(self._stock),
+                "carts_holding": len(self._holds),
+                "units_reserved": sum(self._reserved.values()),
+            }
+
+    def _held(self, product_id, user_id):
+        return self._holds.get(user_id, {}).get(product_id, (0, None))[0]
+
+    def _available(self, product_id, user_id):
+        stock = self._stock.get(product_id)
+        if stock is None:
+            return None
+        return stock - self._reserved.get(product_id, 0) + self._held(product_id, user_id)
+
+    def _set_hold(self, user_id, product_id, quantity, expires_at):
+        held = self._holds.setdefault(user_id, {})
+        previous = held.pop(product_id, (0, None))[0]
+        reserved = self._reserved.get(product_id, 0) - previous + quantity
+        if reserved > 0:
+            self._reserved[product_id] = reserved
+        else:
+            self._reserved.pop(product_id, None)
+
+        if quantity > 0:
+            held[product_id] = (quantity, expires_at)
+            heapq.heappush(self._expiries, (expires_at, user_id, product_id))
+        if not held:
+            del self._holds[user_id]
+
+    def _expire(self, now):
+        while self._expiries and self._expiries[0][0] <= now:
+            expires_at, user_id, product_id = heapq.heappop(self._expiries)
+            hold = self._holds.get(user_id, {}).get(product_id)
+            # Renewed holds leave stale heap entries behind; only drop the current one
+            if hold is not None and hold[1] == expires_at:
+                self._set_hold(user_id, product_id, 0, None)
+
+
+_ledger = None
+_ledger_lock = threading.Lock()
+_sync_requested = threading.Event()
+
+
+def _sync_stock(interval):
+    while True:
+        _sync_requested.wait(interval)
+        _sync_requested.clear()
+        try:
+            get_catalogue().prefetch()
+        except Exception as e:
+            logging.error(f"Stock sync failed: {e}")
+
+
+def request_stock_sync():
+    """
+    Asks the sync thread to re-read upstream stock now instead of waiting for the
+    next interval (e.g. after a hold was refused because a product's stock is unknown).
+    """
+    _sync_requested.set()
+
+
+def get_ledger():
+    """
+    Returns the process-wide reservation ledger, fed by the product catalogue cache
+    and re-synced with upstream stock every STOCK_SYNC_INTERVAL seconds.
+    """
+    global _ledger
+    if _ledger is None:
+        with _ledger_lock:
+            if _ledger is None:
+                ledger = ReservationLedger()
+                catalogue = get_catalogue()
+                catalogue.add_listener(ledger.apply)
+                catalogue.ensure_fresh()
+                threading.Thread(target=_sync_stock, args=(STOCK_SYNC_INTERVAL,), daemon=True).start()
+                _ledger = ledger
+    return _ledger
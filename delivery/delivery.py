@@ -23,6 +23,10 @@ EMAIL_QUEUE_NAME = 'send_email_queue'
 
 USER_SERVICE_URL = "http://profile:5001/profile"
 
+# Each delivery waits on the external JohnnyAPI, so deliveries are created concurrently
+CONSUMER_WORKERS = 4
+CONSUMER_PREFETCH = 8
+
 EXTERNAL_URL = "https://personal-slqn7xxm.outsystemscloud.com/ESDProject_VanNova_/rest/JohnnyAPI"
 
 app = Flask(__name__)
@@ -67,15 +71,13 @@ def do_order_delivery(body): #for orders
         "message" : body["message"],
         "user_details" : user_details,
         "cart" :body["cart"],
+        "cart_totals" : body.get("cart_totals"),  # exact totals in cents, for the email
         "delivery" : response["order"]
     }
 
-    connection, channel = rabbit.connect(RABBITMQ_HOST, RABBITMQ_PORT, EMAIL_EXCHANGE, "direct", {EMAIL_QUEUE_NAME: "send_email"}) #redundancy
-
     print("SENDING TO EMAIL MS")
-    rabbit.publish_message(channel, EMAIL_EXCHANGE, "send_email", message)
+    rabbit.get_publisher(RABBITMQ_HOST, RABBITMQ_PORT).publish(EMAIL_EXCHANGE, "direct", "send_email", message, {EMAIL_QUEUE_NAME: "send_email"}) #redundancy
 
-    rabbit.close(connection, channel)
     return jsonify({"code": 200, "message": "Delivery for Order added, Sent to Email MS"}), 200
 
 #create an order
@@ -143,12 +145,9 @@ def do_verified_delivery(body):
         "delivery" : response["order"] 
     }
 
-    connection, channel = rabbit.connect(RABBITMQ_HOST, RABBITMQ_PORT, EMAIL_EXCHANGE, "direct", {EMAIL_QUEUE_NAME: "send_email"}) #redundancy
-
     print("SENDING TO EMAIL MS")
-    rabbit.publish_message(channel, EMAIL_EXCHANGE, "send_email", message)
+    rabbit.get_publisher(RABBITMQ_HOST, RABBITMQ_PORT).publish(EMAIL_EXCHANGE, "direct", "send_email", message, {EMAIL_QUEUE_NAME: "send_email"}) #redundancy
 
-    rabbit.close(connection, channel)
     return jsonify({"code": 200, "message": "Delivery for Verification added, Sent to Email MS"}), 200
 
 @app.route('/delivery/<int:user_id>/<order_id>', methods=['GET'])
@@ -206,10 +205,12 @@ if __name__ == '__main__':
     # IS A CONSUMER
     # Start consumers in separate threads
     def start_consuming_place_order():
-        rabbit.start_consuming(RABBITMQ_HOST, RABBITMQ_PORT, PLACE_ORDER_EXCHANGE_NAME, "fanout", DELIVERY_PLACE_ORDER_QUEUE_NAME, callback=callback)
+        rabbit.start_consuming(RABBITMQ_HOST, RABBITMQ_PORT, PLACE_ORDER_EXCHANGE_NAME, "fanout", DELIVERY_PLACE_ORDER_QUEUE_NAME, callback=callback,
+                               prefetch_count=CONSUMER_PREFETCH, workers=CONSUMER_WORKERS)
 
     def start_consuming_verification():
-        rabbit.start_consuming(RABBITMQ_HOST, RABBITMQ_PORT, VERIFICATION_EXCHANGE_NAME, "direct", DELIVERY_VERIFICATION_QUEUE_NAME, callback=callback)
+        rabbit.start_consuming(RABBITMQ_HOST, RABBITMQ_PORT, VERIFICATION_EXCHANGE_NAME, "direct", DELIVERY_VERIFICATION_QUEUE_NAME, callback=callback,
+                               prefetch_count=CONSUMER_PREFETCH, workers=CONSUMER_WORKERS)
 
     # Start each consumer in its own thread
     threading.Thread(target=start_consuming_place_order).start()
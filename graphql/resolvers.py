@@ -1,10 +1,11 @@
 import requests
 from graphql_types import CartItemType, ProductType
+from utils.invokes import get_session, DEFAULT_TIMEOUT
 
 # Fetch Cart data from the Cart service
 def fetch_cart(user_id):
     try:
-        response = requests.get(f"http://cart:5201/cart/{user_id}")
+        response = get_session().get(f"http://cart:5201/cart/{user_id}", timeout=DEFAULT_TIMEOUT)
         response.raise_for_status()
         cart_data = response.json().get('cart', {})
         return [
@@ -29,7 +30,7 @@ def fetch_cart(user_id):
 # Fetch Recommendations data from the Recommendation service
 def fetch_recommendations(user_id):
     try:
-        response = requests.get(f"http://recommendation:5204/recommendations/{user_id}")
+        response = get_session().get(f"http://recommendation:5204/recommendations/{user_id}", timeout=DEFAULT_TIMEOUT)
         response.raise_for_status()
         recommendations = response.json().get('recommendations', [])
         return [
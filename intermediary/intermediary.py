@@ -5,6 +5,7 @@ from flask import Flask
 import threading
 import logging
 import utils.amqp_lib as rabbit
+from utils.invokes import get_session, DEFAULT_TIMEOUT
 
 # RabbitMQ Connection Details
 RABBITMQ_HOST = 'rabbitmq'  
@@ -12,6 +13,10 @@ RABBITMQ_PORT = 5672
 PRODUCT_QUEUE_NAME = "product_queue"   
 PLACE_ORDER_EXCHANGE_NAME = "place_order_exchange"
 
+# Stock updates go to the external OutSystems API, so orders are processed concurrently
+CONSUMER_WORKERS = 4
+CONSUMER_PREFETCH = 8
+
 # Product Microservice API
 PRODUCT_SERVICE_URL = "https://personal-o2kymv2n.outsystemscloud.com/SustainaMart/rest/v1/reducestock/"
 
@@ -26,7 +31,7 @@ def reduce_stock(product_id, stock):
     headers = {"Content-Type": "application/json"}
 
     try:
-        response = requests.patch(PRODUCT_SERVICE_URL, json=payload, headers=headers)
+        response = get_session().patch(PRODUCT_SERVICE_URL, json=payload, headers=headers, timeout=DEFAULT_TIMEOUT)
         response.raise_for_status()  # Will raise an HTTPError for bad responses
         logger.info(f"Stock reduced for product {product_id}. Response: {response.status_code} - {response.text}")
     except requests.exceptions.RequestException as e:
@@ -68,4 +73,5 @@ if __name__ == '__main__':
     # Start the RabbitMQ consumer in the main thread
     rabbit.connect(RABBITMQ_HOST, RABBITMQ_PORT, PLACE_ORDER_EXCHANGE_NAME, "fanout", {PRODUCT_QUEUE_NAME: ""})
 
-    rabbit.start_consuming(RABBITMQ_HOST, RABBITMQ_PORT, PLACE_ORDER_EXCHANGE_NAME, "fanout", PRODUCT_QUEUE_NAME, callback=callback)
+    rabbit.start_consuming(RABBITMQ_HOST, RABBITMQ_PORT, PLACE_ORDER_EXCHANGE_NAME, "fanout", PRODUCT_QUEUE_NAME, callback=callback,
+                           prefetch_count=CONSUMER_PREFETCH, workers=CONSUMER_WORKERS)
@@ -1,8 +1,8 @@
 import os
 import json
-import pika
 from supabase import create_client
 from dotenv import load_dotenv
+from amqp_lib import get_publisher
 
 load_dotenv()
 SUPABASE_URL = os.getenv("SUPABASE_URL")
@@ -13,17 +13,8 @@ supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
 
 def publish_event(event: dict):
     try:
-        connection = pika.BlockingConnection(pika.ConnectionParameters(host=RABBITMQ_HOST))
-        channel = connection.channel()
-        channel.exchange_declare(exchange="events.topic", exchange_type="topic", durable=True)
         routing_key = "mission.completed"
-        channel.basic_publish(
-            exchange="events.topic",
-            routing_key=routing_key,
-            body=json.dumps(event),
-            properties=pika.BasicProperties(delivery_mode=2)
-        )
-        connection.close()
+        get_publisher(RABBITMQ_HOST, 5672).publish("events.topic", "topic", routing_key, event)
         print(f"[✓] Published mission completion event: {event}")
     except Exception as e:
         print(f"[!] Failed to publish mission event: {e}")
@@ -125,4 +116,4 @@ from flask_cors import CORS
 
 def enable_cors(app):
     """Enable CORS for the Flask app."""
-    CORS(app, resources={r"/*": {"origins": "http://localhost:5173"}})
\ No newline at end of file
+    CORS(app, resources={r"/*": {"origins": "http://localhost:5173"}})
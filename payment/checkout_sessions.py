@@ -0,0 +1,109 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Stripe sessions created at once in the background
+CHECKOUT_WORKERS = 8
+
+# How long a finished request's result is kept in memory, and how many are kept. The
+# oldest go first past CHECKOUT_RESULT_SIZE, so on a busy day a pendingID that
+# place_order still replays (for IDEMPOTENCY_TTL, place_order/idempotency.py) can
+# fall out before the TTL; status() then falls back to lookup(pending_id).
+CHECKOUT_RESULT_TTL = 86400
+CHECKOUT_RESULT_SIZE = 10000
+
+# Longest a status request may wait for a pending session
+MAX_STATUS_WAIT = 25
+
+PENDING = "pending"
+READY = "ready"
+FAILED = "failed"
+
+
+class CheckoutRequest:
+    def __init__(self, pending_id):
+        self.pending_id = pending_id
+        self.status = PENDING
+        self.payment_id = None
+        self.url = None
+        self.error = None
+        self.finished_at = None
+        self.done = threading.Event()
+
+    def to_dict(self):
+        result = {"pendingID": self.pending_id, "status": self.status}
+        if self.status == READY:
+            result["paymentID"] = self.payment_id
+            result["stripe_session_url"] = self.url
+        elif self.status == FAILED:
+            result["error"] = self.error
+        return result
+
+
+class CheckoutSessionPool:
+    """
+    Creates checkout sessions on a pool of worker threads.
+
+    submit(data) returns a pending id at once and create(data, pending_id) runs in
+    the background, returning (paymentID, session url). Callers poll status(), which
+    can wait up to MAX_STATUS_WAIT seconds for the session to be ready. Results are
+    kept in memory for CHECKOUT_RESULT_TTL seconds after they finish; after that (or
+    after a restart) status() asks lookup(pending_id), which returns the stored
+    request as a dict or None.
+    """
+
+    def __init__(self, create, lookup=None, workers=CHECKOUT_WORKERS, result_ttl=CHECKOUT_RESULT_TTL, result_size=CHECKOUT_RESULT_SIZE):
+        self.create = create
+        self.lookup = lookup
+        self.result_ttl = result_ttl
+        self.result_size = result_size
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="checkout")
+        self._requests = OrderedDict()  # pending_id -> CheckoutRequest
+        self._lock = threading.Lock()
+
+    def submit(self, data):
+        pending_id = uuid.uuid4().hex
+        checkout = CheckoutRequest(pending_id)
+        with self._lock:
+            self._evict(time.monotonic())
+            self._requests[pending_id] = checkout
+        self._executor.submit(self._run, checkout, data)
+        return pending_id
+
+    def status(self, pending_id, wait=0):
+        """ Returns the request as a dict, or None if it's unknown or has expired """
+        with self._lock:
+            self._evict(time.monotonic())
+            checkout = self._requests.get(pending_id)
+        if checkout is None:
+            return self.lookup(pending_id) if self.lookup else None
+        if wait > 0:
+            checkout.done.wait(min(wait, MAX_STATUS_WAIT))
+        return checkout.to_dict()
+
+    def _run(self, checkout, data):
+        try:
+            checkout.payment_id, checkout.url = self.create(data, checkout.pending_id)
+            checkout.status = READY
+        except Exception as e:
+            print(f"Error creating checkout session {checkout.pending_id}: {e}")
+            checkout.error = str(e)
+            checkout.status = FAILED
+        checkout.finished_at = time.monotonic()
+        checkout.done.set()
+
+    def _evict(self, now):
+        # Requests are in submission order; drop finished ones past their TTL from the front,
+        # and the oldest finished ones once over the size limit
+        stale = []
+        for pending_id, checkout in self._requests.items():
+            over_size = len(self._requests) - len(stale) > self.result_size
+            expired = checkout.finished_at is not None and now - checkout.finished_at >= self.result_ttl
+            if not (over_size or expired):
+                break
+            if checkout.finished_at is not None:
+                stale.append(pending_id)
+        for pending_id in stale:
+            del self._requests[pending_id]
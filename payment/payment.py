@@ -7,7 +7,10 @@ from datetime import datetime, timezone
 import pika
 import json
 import utils.amqp_lib as rabbit
+from utils.invokes import invoke_http_async
 from utils.cors_config import enable_cors
+from checkout_sessions import CheckoutSessionPool, READY
+from webhook_events import WebhookEventQueue
 from flask import render_template_string
 
 # Load environment variables
@@ -25,9 +28,37 @@ supabase: Client = create_client(supabase_url, supabase_key)
 stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
 
 # Initialize AMQP variables
+RABBITMQ_HOST = "rabbitmq"
+RABBITMQ_PORT = 5672
 PAYMENT_EXCHANGE_NAME = "payment_exchange"
 PAYMENT_QUEUE_NAME = "payment_queue"
 PAYMENT_ROUTING_KEY = "payment_success"
+PUBLISH_CONFIRM_TIMEOUT = 30
+
+# Flask's debug reloader runs the app in a child process (WERKZEUG_RUN_MAIN=true);
+# background threads such as the webhook drain must start only where requests are served
+USE_RELOADER = True
+
+# Stock held for a cart is released when its checkout session expires
+RESERVATION_RELEASE_URL = "http://cart_product:5300/cart-product/release"
+
+# Checkout sessions requested in async mode are created on this pool. The pending id
+# doubles as the Stripe idempotency key, so a retried worker call can't open a second session.
+checkout_pool = CheckoutSessionPool(
+    lambda data, pending_id: create_checkout_session(data, idempotency_key=pending_id),
+    lookup=lambda pending_id: find_checkout_session(pending_id)
+)
+
+# Verified webhook events are queued here and handled by handle_stripe_event
+webhook_queue = WebhookEventQueue(supabase, lambda event: handle_stripe_event(event))
+
+# payments.cart_details holds the cart snapshot taken at checkout (JSON text), and
+# payments.cart_totals its running totals from the cart service:
+#   alter table payments add column if not exists cart_totals text;
+# payments.pending_id is the pendingID of an async checkout, so its status can still
+# be found once the in-memory result is gone:
+#   alter table payments add column if not exists pending_id text;
+#   create index if not exists payments_pending_id on payments (pending_id);
 
 # Create a Payment Session
 @app.route('/payment', methods=['POST'])
@@ -35,62 +66,106 @@ def create_payment():
     data = request.json
     print(f"Received request data: {data}")  # Debugging logs
 
+    # In async mode the Stripe call happens on a worker; poll /payment/<pendingID>/status for the URL
+    if data.get('async') or request.args.get('async') == 'true':
+        pending_id = checkout_pool.submit(data)
+        return jsonify({
+            'pendingID': pending_id,
+            'status': 'pending',
+            'status_url': f"/payment/{pending_id}/status"
+        }), 202
+
+    try:
+        payment_id, session_url = create_checkout_session(data)
+        return jsonify({'paymentID': payment_id, 'stripe_session_url': session_url}), 201
+    except Exception as e:
+        print(f"Error in create_payment(): {str(e)}")  # Log the full error
+        return jsonify({'error': str(e)}), 500
+
+# Poll an asynchronous payment; ?wait=<seconds> holds the request until the session is ready
+@app.route('/payment/<string:pendingID>/status', methods=['GET'])
+def get_payment_status(pendingID):
+    result = checkout_pool.status(pendingID, wait=request.args.get('wait', 0, type=float))
+    if result is None:
+        return jsonify({'error': 'Pending payment not found'}), 404
+    return jsonify(result), 200
+
+def create_checkout_session(data, idempotency_key=None):
+    """ Creates the Stripe Checkout session and its payments row, returning (paymentID, session url) """
     user_id = data.get('userID')
     amount = data.get('amount')
+    # place_order sends the exact amount in cents; fall back to converting the float amount
+    amount_cents = data.get('amountCents')
+    if amount_cents is None:
+        amount_cents = round(amount * 100)
     currency = data.get('currency', 'SGD')
     cart_details = data.get('cart', [])
+    cart_totals = data.get('cartTotals')
     
     # Get voucher information if provided
     voucher_id = data.get('voucherId')
     voucher_value = data.get('voucherValue')
     original_amount = data.get('originalAmount')
 
-    try:
-        # Create a Stripe Checkout session
-        session = stripe.checkout.Session.create(
-            payment_method_types=['card'],
-            line_items=[{
-                'price_data': {
-                    'currency': currency,
-                    'product_data': {'name': 'Eco-friendly Purchase'},
-                    'unit_amount': int(amount * 100)  # Stripe requires amount in cents
-                },
-                'quantity': 1,
-            }],
-            mode='payment',
-            success_url=os.getenv("SUCCESS_URL"),
-            cancel_url=os.getenv("CANCEL_URL"),
-        )
-
-        print(f"Stripe session created: {session.id}")  # Debugging log
-
-        # Prepare payment data for Supabase
-        payment_data = {
-            "userID": user_id,
-            "amount": amount,
-            "currency": currency,
-            "payment_status": "pending",
-            "cart_details": json.dumps(cart_details),
-            "stripe_payment_id": session.id,
-            "created_at": datetime.now(timezone.utc).isoformat()
-        }
-        
-        # Add voucher information if provided
-        if voucher_id:
-            payment_data["voucherId"] = voucher_id
-            payment_data["voucherValue"] = voucher_value
-            payment_data["originalAmount"] = original_amount
-            print(f"Storing voucher info: voucherId={voucher_id}, value={voucher_value}")
-
-        # Store payment in Supabase
-        response = supabase.table("payments").insert(payment_data).execute()
-
-        print(f"Supabase insert response: {response}")  # Debugging log
-
-        return jsonify({'paymentID': session.id, 'stripe_session_url': session.url}), 201
-    except Exception as e:
-        print(f"Error in create_payment(): {str(e)}")  # Log the full error
-        return jsonify({'error': str(e)}), 500
+    # Create a Stripe Checkout session
+    session = stripe.checkout.Session.create(
+        payment_method_types=['card'],
+        line_items=[{
+            'price_data': {
+                'currency': currency,
+                'product_data': {'name': 'Eco-friendly Purchase'},
+                'unit_amount': int(amount_cents)  # Stripe requires amount in cents
+            },
+            'quantity': 1,
+        }],
+        mode='payment',
+        success_url=os.getenv("SUCCESS_URL"),
+        cancel_url=os.getenv("CANCEL_URL"),
+        idempotency_key=idempotency_key
+    )
+
+    print(f"Stripe session created: {session.id}")  # Debugging log
+
+    # Prepare payment data for Supabase
+    payment_data = {
+        "userID": user_id,
+        "amount": amount,
+        "currency": currency,
+        "payment_status": "pending",
+        "cart_details": json.dumps(cart_details),
+        "stripe_payment_id": session.id,
+        "created_at": datetime.now(timezone.utc).isoformat()
+    }
+
+    # In async mode the idempotency key is the pendingID
+    if idempotency_key:
+        payment_data["pending_id"] = idempotency_key
+
+    if cart_totals:
+        payment_data["cart_totals"] = json.dumps(cart_totals)
+
+    # Add voucher information if provided
+    if voucher_id:
+        payment_data["voucherId"] = voucher_id
+        payment_data["voucherValue"] = voucher_value
+        payment_data["originalAmount"] = original_amount
+        print(f"Storing voucher info: voucherId={voucher_id}, value={voucher_value}")
+
+    # Store payment in Supabase
+    response = supabase.table("payments").insert(payment_data).execute()
+
+    print(f"Supabase insert response: {response}")  # Debugging log
+
+    return session.id, session.url
+
+def find_checkout_session(pending_id):
+    """ Rebuilds an async checkout's status from its payments row, or returns None if there is none """
+    response = supabase.table("payments").select("stripe_payment_id").eq("pending_id", pending_id).execute()
+    if not response.data:
+        return None
+    payment_id = response.data[0]["stripe_payment_id"]
+    session = stripe.checkout.Session.retrieve(payment_id)
+    return {"pendingID": pending_id, "status": READY, "paymentID": payment_id, "stripe_session_url": session.url}
 
 # Retrieve a Payment by ID
 @app.route('/payment/<string:paymentID>', methods=['GET'])
@@ -128,8 +203,18 @@ def stripe_webhook():
         print('Webhook signature verification failed: ' + str(e))
         return jsonify(success=False), 400
 
+    # Acknowledge at once; the event is handled by the webhook queue's drain thread
+    if webhook_queue.enqueue(event['id'], event['type'], payload.decode('utf-8')):
+        print(f"Queued Stripe event {event['id']}: {event['type']}")
+    else:
+        print(f"Duplicate Stripe event {event['id']}: {event['type']}, ignoring")
+
+    return jsonify(success=True), 200
+
+def handle_stripe_event(event):
+    """ Applies a queued Stripe event; raises if it should be retried """
     event_type = event['type']
-    print(f"Received Stripe event: {event_type}")
+    print(f"Handling Stripe event {event['id']}: {event_type}")
 
     if event_type == 'checkout.session.completed':
         session = event['data']['object']
@@ -142,13 +227,15 @@ def stripe_webhook():
                 {"payment_status": "successful"}).eq("stripe_payment_id", session['id']).execute()
             print(f"Updated payment status in Supabase: {update_response}")
 
-            connection, channel = rabbit.connect("rabbitmq", 5672, PAYMENT_EXCHANGE_NAME, "topic")
-
-            # Create message with all necessary data including voucher information
+            # Create message with all necessary data including voucher information.
+            # The cart snapshot taken at checkout travels with it, so fulfilment ships
+            # what was paid for without re-reading the (possibly edited) live cart.
             message = {
                 'paymentID': session['id'],
                 'status': 'successful',
-                'userID': payment_data['userID']
+                'userID': payment_data['userID'],
+                'cart': json.loads(payment_data['cart_details']) if payment_data.get('cart_details') else None,
+                'cartTotals': json.loads(payment_data['cart_totals']) if payment_data.get('cart_totals') else None
             }
             
             # Add voucher information if it exists in the payment data
@@ -161,16 +248,20 @@ def stripe_webhook():
 
             print(f"Publishing message to topic exchange '{PAYMENT_EXCHANGE_NAME}' with routing key='{PAYMENT_ROUTING_KEY}'")
             print(f"Message content: {json.dumps(message, indent=2)}")
-            rabbit.publish_message(channel, PAYMENT_EXCHANGE_NAME, PAYMENT_ROUTING_KEY, message)
-            connection.close()
+            # Only count the event as handled once the broker has confirmed the message
+            rabbit.get_publisher(RABBITMQ_HOST, RABBITMQ_PORT, confirm=True).publish(
+                PAYMENT_EXCHANGE_NAME, "topic", PAYMENT_ROUTING_KEY, message
+            ).result(timeout=PUBLISH_CONFIRM_TIMEOUT)
         else:
             print(f"No matching payment found in Supabase for session ID: {session['id']}")
 
     elif event_type == 'checkout.session.expired':
         session = event['data']['object']
         print(f"Checkout session expired: {session['id']}")
-        supabase.table("payments").update(
+        update_response = supabase.table("payments").update(
             {"payment_status": "expired"}).eq("stripe_payment_id", session['id']).execute()
+        for payment_data in update_response.data:
+            invoke_http_async(RESERVATION_RELEASE_URL, "POST", json={"userID": payment_data['userID']})
 
     elif event_type == 'payment_intent.payment_failed':
         intent = event['data']['object']
@@ -185,8 +276,6 @@ def stripe_webhook():
     else:
         print(f"Unhandled event type: {event_type}")
 
-    return jsonify(success=True), 200
-
 # Payment success redirection
 @app.route('/payment/success', methods=['GET'])
 def order_success():
@@ -307,10 +396,14 @@ def order_cancel():
     
 if __name__ == '__main__':
     rabbit.connect( #create the payment exchange name and queue
-        "rabbitmq",
-        5672,
+        RABBITMQ_HOST,
+        RABBITMQ_PORT,
         PAYMENT_EXCHANGE_NAME,
         "topic",
         {PAYMENT_QUEUE_NAME:PAYMENT_ROUTING_KEY}
     )
-    app.run(host='0.0.0.0', port=5202, debug=True)
\ No newline at end of file
+    # With the reloader on, the parent process only watches files and the child serves;
+    # without it this process serves, so the queue is drained here
+    if not USE_RELOADER or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        webhook_queue.start()
+    app.run(host='0.0.0.0', port=5202, debug=True, use_reloader=USE_RELOADER)
\ No newline at end of file
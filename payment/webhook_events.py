@@ -0,0 +1,164 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+# Local queue of verified webhook events, on a volume so it survives restarts
+WEBHOOK_QUEUE_PATH = os.getenv("WEBHOOK_QUEUE_PATH", "data/webhook_events.db")
+
+# Stripe event ids already handled, shared by every payment instance:
+#
+#   create table stripe_events (
+#       event_id text primary key,
+#       event_type text not null,
+#       processed_at timestamptz not null default now()
+#   );
+#   create index on stripe_events (processed_at);
+#
+# Postgres has no TTL index; rows older than SEEN_EVENT_TTL are deleted by the drain loop.
+STRIPE_EVENTS_TABLE = "stripe_events"
+
+# Stripe retries an undelivered event for up to three days
+SEEN_EVENT_TTL = 7 * 86400
+PURGE_INTERVAL = 3600
+
+# Backoff between attempts at an event whose handler failed
+RETRY_BASE = 2
+RETRY_MAX = 300
+
+# Events still failing after this many attempts are parked: kept in the local queue
+# with parked_at set for someone to look at, but no longer retried
+MAX_ATTEMPTS = 20
+
+
+class WebhookEventQueue:
+    """
+    Durable queue between the Stripe webhook and the code that acts on its events.
+
+    The webhook only verifies an event and enqueues it, then acknowledges Stripe.
+    A duplicate event id is dropped on enqueue. One drain thread hands queued
+    events to handler(event) in arrival order and retries failed ones with
+    backoff. Event ids are kept locally, and in the stripe_events table once
+    handled (so other instances and rebuilt volumes skip them too), for
+    SEEN_EVENT_TTL seconds. An event that fails MAX_ATTEMPTS times is parked.
+    """
+
+    def __init__(self, supabase, handler, path=WEBHOOK_QUEUE_PATH, ttl=SEEN_EVENT_TTL):
+        self.supabase = supabase
+        self.handler = handler
+        self.ttl = ttl
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("pragma journal_mode=wal")
+        self._db.execute("""
+            create table if not exists webhook_events (
+                event_id text primary key,
+                event_type text not null,
+                payload text not null,
+                received_at real not null,
+                next_attempt_at real not null,
+                attempts integer not null default 0,
+                processed_at real,
+                parked_at real
+            )
+        """)
+        columns = [row[1] for row in self._db.execute("pragma table_info(webhook_events)")]
+        if "parked_at" not in columns:
+            self._db.execute("alter table webhook_events add column parked_at real")
+        self._db.execute("create index if not exists webhook_events_pending on webhook_events (processed_at, next_attempt_at)")
+        self._db.commit()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def enqueue(self, event_id, event_type, payload):
+        """ Stores a verified event; returns False if the event id was already seen """
+        now = time.time()
+        with self._lock:
+            cursor = self._db.execute(
+                "insert or ignore into webhook_events (event_id, event_type, payload, received_at, next_attempt_at) values (?, ?, ?, ?, ?)",
+                (event_id, event_type, payload, now, now)
+            )
+            self._db.commit()
+        if cursor.rowcount == 0:
+            return False
+        self._wake.set()
+        return True
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._drain, daemon=True)
+            self._thread.start()
+
+    def _drain(self):
+        last_purge = 0
+        while True:
+            if time.time() - last_purge >= PURGE_INTERVAL:
+                try:
+                    self._purge()
+                except Exception as e:
+                    print(f"Could not purge seen webhook events: {e}")
+                last_purge = time.time()
+
+            row = self._next()
+            if row is None:
+                self._wake.wait(1)
+                self._wake.clear()
+                continue
+            self._process(*row)
+
+    def _next(self):
+        with self._lock:
+            return self._db.execute(
+                "select event_id, event_type, payload, attempts from webhook_events "
+                "where processed_at is null and parked_at is null and next_attempt_at <= ? order by received_at limit 1",
+                (time.time(),)
+            ).fetchone()
+
+    def _process(self, event_id, event_type, payload, attempts):
+        try:
+            seen = self.supabase.table(STRIPE_EVENTS_TABLE).select("event_id").eq("event_id", event_id).execute()
+            if seen.data:
+                print(f"Stripe event {event_id} was already handled, skipping")
+            else:
+                self.handler(json.loads(payload))
+                self.supabase.table(STRIPE_EVENTS_TABLE).upsert({
+                    "event_id": event_id,
+                    "event_type": event_type,
+                    "processed_at": datetime.now(timezone.utc).isoformat()
+                }).execute()
+        except Exception as e:
+            if attempts + 1 >= MAX_ATTEMPTS:
+                print(f"Error handling Stripe event {event_id} (attempt {attempts + 1}), parking it: {e}")
+                with self._lock:
+                    self._db.execute(
+                        "update webhook_events set attempts = attempts + 1, parked_at = ? where event_id = ?",
+                        (time.time(), event_id)
+                    )
+                    self._db.commit()
+                return
+            delay = min(RETRY_BASE ** attempts, RETRY_MAX)
+            print(f"Error handling Stripe event {event_id} (attempt {attempts + 1}), retrying in {delay}s: {e}")
+            with self._lock:
+                self._db.execute(
+                    "update webhook_events set attempts = attempts + 1, next_attempt_at = ? where event_id = ?",
+                    (time.time() + delay, event_id)
+                )
+                self._db.commit()
+            return
+
+        with self._lock:
+            self._db.execute("update webhook_events set processed_at = ?, payload = '' where event_id = ?", (time.time(), event_id))
+            self._db.commit()
+
+    def _purge(self):
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            self._db.execute("delete from webhook_events where processed_at < ?", (cutoff,))
+            self._db.commit()
+        self.supabase.table(STRIPE_EVENTS_TABLE).delete().lt(
+            "processed_at", (datetime.now(timezone.utc) - timedelta(seconds=self.ttl)).isoformat()
+        ).execute()
@@ -0,0 +1,205 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from datetime import datetime, timedelta, timezone
+from utils.supabase import get_supabase
+
+# Responses to requests sent with an Idempotency-Key, kept for IDEMPOTENCY_TTL seconds:
+#
+#   create table idempotency_keys (
+#       key text primary key,
+#       fingerprint text not null,                -- hash of the request body
+#       status text not null,                     -- 'in_progress' | 'completed'
+#       response jsonb,
+#       status_code integer,
+#       created_at timestamptz not null default now()
+#   );
+#   create index on idempotency_keys (created_at);
+#
+# Postgres has no TTL index; rows older than IDEMPOTENCY_TTL are deleted at most
+# once every PURGE_INTERVAL seconds by whichever request comes along.
+IDEMPOTENCY_TABLE = "idempotency_keys"
+IDEMPOTENCY_TTL = 86400
+PURGE_INTERVAL = 3600
+
+# An 'in_progress' row older than this is assumed to belong to a process that died
+# mid-request, and the next request with the key takes it over
+CLAIM_TIMEOUT = 120
+
+# Postgres error code for a duplicate primary key
+UNIQUE_VIOLATION = "23505"
+
+# Completed responses also kept in memory (LRU)
+IDEMPOTENCY_CACHE_SIZE = 10000
+
+IN_PROGRESS = "in_progress"
+COMPLETED = "completed"
+
+
+class IdempotencyStore:
+    """
+    Replays the stored response for a repeated Idempotency-Key instead of running
+    the request again.
+
+    Completed responses are looked up in memory first, then in the database. A
+    duplicate that arrives while the first request is still running in this
+    process waits for it and gets the same response; one running in another
+    process gets a 409, until its claim is claim_timeout old and can be taken over.
+    Server errors (5xx) aren't stored, so the client can retry.
+    """
+
+    def __init__(self, supabase=None, ttl=IDEMPOTENCY_TTL, cache_size=IDEMPOTENCY_CACHE_SIZE, claim_timeout=CLAIM_TIMEOUT):
+        self.supabase = supabase or get_supabase()
+        self.ttl = ttl
+        self.claim_timeout = claim_timeout
+        self.cache_size = cache_size
+        self._completed = OrderedDict()  # key -> (fingerprint, response, status_code, stored_at)
+        self._in_flight = {}  # key -> (fingerprint, Future)
+        self._last_purge = None
+        self._lock = threading.Lock()
+
+    def run(self, key, fingerprint, handler):
+        """
+        Returns (response, status_code, replayed). handler() -> (response, status_code)
+        runs at most once per key within the TTL.
+        """
+        self._maybe_purge()
+        with self._lock:
+            cached = self._cached(key)
+            in_flight = self._in_flight.get(key)
+            if cached is None and in_flight is None:
+                future = Future()
+                self._in_flight[key] = (fingerprint, future)
+
+        if cached is not None:
+            return self._replay(fingerprint, *cached)
+        if in_flight is not None:
+            # Coalesce with the identical request already running here
+            if in_flight[0] != fingerprint:
+                return self._mismatch()
+            response, status_code = in_flight[1].result()
+            return response, status_code, True
+
+        try:
+            result = self._run_once(key, fingerprint, handler)
+            future.set_result(result[:2])
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+
+    def _run_once(self, key, fingerprint, handler):
+        stored = self._load(key)
+        if stored is not None:
+            if stored["status"] == COMPLETED:
+                self._remember(key, stored["fingerprint"], stored["response"], stored["status_code"])
+                return self._replay(fingerprint, stored["fingerprint"], stored["response"], stored["status_code"])
+            if stored["fingerprint"] != fingerprint:
+                return self._mismatch()
+            if not self._take_over(key, stored):
+                return self._in_progress()
+        else:
+            try:
+                self.supabase.table(IDEMPOTENCY_TABLE).insert({
+                    "key": key,
+                    "fingerprint": fingerprint,
+                    "status": IN_PROGRESS,
+                    "created_at": datetime.now(timezone.utc).isoformat()
+                }).execute()
+            except Exception as e:
+                if getattr(e, "code", None) != UNIQUE_VIOLATION:
+                    raise
+                # Another process claimed the key between our read and insert
+                return self._in_progress()
+
+        try:
+            response, status_code = handler()
+        except Exception:
+            self._forget(key)
+            raise
+
+        if status_code >= 500:
+            self._forget(key)
+        else:
+            self.supabase.table(IDEMPOTENCY_TABLE).update({
+                "status": COMPLETED,
+                "response": response,
+                "status_code": status_code
+            }).eq("key", key).execute()
+            self._remember(key, fingerprint, response, status_code)
+        return response, status_code, False
+
+    def _load(self, key):
+        """ Returns the stored row for key, dropping it if it has expired """
+        response = self.supabase.table(IDEMPOTENCY_TABLE).select("*").eq("key", key).execute()
+        if not response.data:
+            return None
+        row = response.data[0]
+        if datetime.fromisoformat(row["created_at"]) < datetime.now(timezone.utc) - timedelta(seconds=self.ttl):
+            self.supabase.table(IDEMPOTENCY_TABLE).delete().eq("key", key).eq("created_at", row["created_at"]).execute()
+            return None
+        return row
+
+    def _maybe_purge(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._last_purge is not None and now - self._last_purge < PURGE_INTERVAL:
+                return
+            self._last_purge = now
+        try:
+            self.supabase.table(IDEMPOTENCY_TABLE).delete().lt(
+                "created_at", (datetime.now(timezone.utc) - timedelta(seconds=self.ttl)).isoformat()
+            ).execute()
+        except Exception as e:
+            print(f"Could not purge expired idempotency keys: {e}")
+
+    def _take_over(self, key, row):
+        """ Claims an abandoned in_progress row; returns False while its owner may still be running """
+        now = datetime.now(timezone.utc)
+        if datetime.fromisoformat(row["created_at"]) > now - timedelta(seconds=self.claim_timeout):
+            return False
+        # Compare-and-set on created_at so only one process takes over
+        takeover = (
+            self.supabase.table(IDEMPOTENCY_TABLE)
+            .update({"created_at": now.isoformat()})
+            .eq("key", key)
+            .eq("status", IN_PROGRESS)
+            .eq("created_at", row["created_at"])
+            .execute()
+        )
+        return bool(takeover.data)
+
+    def _forget(self, key):
+        self.supabase.table(IDEMPOTENCY_TABLE).delete().eq("key", key).eq("status", IN_PROGRESS).execute()
+
+    def _replay(self, fingerprint, stored_fingerprint, response, status_code):
+        if fingerprint != stored_fingerprint:
+            return self._mismatch()
+        return response, status_code, True
+
+    def _in_progress(self):
+        return {"code": 409, "message": "A request with this Idempotency-Key is already in progress."}, 409, False
+
+    def _mismatch(self):
+        return {"code": 422, "message": "Idempotency-Key was already used with a different request body."}, 422, False
+
+    def _cached(self, key):
+        entry = self._completed.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[3] >= self.ttl:
+            del self._completed[key]
+            return None
+        self._completed.move_to_end(key)
+        return entry[:3]
+
+    def _remember(self, key, fingerprint, response, status_code):
+        with self._lock:
+            self._completed[key] = (fingerprint, response, status_code, time.monotonic())
+            self._completed.move_to_end(key)
+            while len(self._completed) > self.cache_size:
+                self._completed.popitem(last=False)
@@ -3,8 +3,11 @@ import sys
 from flask import Flask, request, jsonify
 import pika
 import json
-from utils.invokes import invoke_http
+import hashlib
+from utils.invokes import invoke_http, invoke_many
 import utils.amqp_lib as rabbit
+from processed_payments import ProcessedPayments, CLAIMED, ALREADY_PUBLISHED
+from idempotency import IdempotencyStore
 import threading
 from utils.cors_config import enable_cors
 
@@ -27,6 +30,23 @@ PAYMENT_ROUTING_KEY = "payment_success"
 
 PLACE_ORDER_EXCHANGE_NAME = "place_order_exchange"
 
+# Payment messages that fail are republished to the retry queue, which dead-letters them
+# back onto payment_queue after RETRY_DELAY_MS (through the default exchange, so only this
+# queue sees them again). After MAX_DELIVERY_ATTEMPTS they are parked for a human instead.
+PAYMENT_RETRY_QUEUE_NAME = "payment_queue.retry"
+PAYMENT_PARKING_QUEUE_NAME = "payment_queue.parking"
+RETRY_DELAY_MS = 30000
+MAX_DELIVERY_ATTEMPTS = 5
+ATTEMPTS_HEADER = "x-attempts"
+
+# Payment messages handled at once, and how long to wait for the fanout to be confirmed
+CONSUMER_WORKERS = 4
+CONSUMER_PREFETCH = 8
+PUBLISH_CONFIRM_TIMEOUT = 30
+
+processed_payments = ProcessedPayments()
+idempotency_store = IdempotencyStore()
+
 @app.route("/place_order", methods=['POST'])
 def place_order():
     """ Handles the entire order process: Retrieve Cart --> Payment Creation """
@@ -44,10 +64,28 @@ def place_order():
         voucher_id = request.json.get("voucherId")
         voucher_value = request.json.get("voucherValue", 0)
 
-        # Process the order through Cart and Payment Microservices
-        result = processPlaceOrder(user_id, voucher_id, voucher_value)
+        # With "async": true the Stripe session is created in the background and the
+        # client polls the payment status URL returned in payment_details
+        async_payment = bool(request.json.get("async"))
 
-        return jsonify(result), result["code"]
+        # Process the order through Cart and Payment Microservices
+        def handler():
+            result = processPlaceOrder(user_id, voucher_id, voucher_value, async_payment)
+            return result, result["code"]
+
+        # Retries and double-clicks sent with the same Idempotency-Key get the first
+        # response back instead of opening another Stripe session
+        idempotency_key = request.headers.get("Idempotency-Key")
+        if not idempotency_key:
+            result, code = handler()
+            return jsonify(result), code
+
+        fingerprint = hashlib.sha256(json.dumps(request.json, sort_keys=True).encode()).hexdigest()
+        result, code, replayed = idempotency_store.run(f"{user_id}:{idempotency_key}", fingerprint, handler)
+        response = jsonify(result)
+        if replayed:
+            response.headers["Idempotent-Replayed"] = "true"
+        return response, code
     
     except Exception as e:
         exc_type, exc_obj, exc_tb = sys.exc_info()
@@ -60,7 +98,7 @@ def place_order():
             "message": "place_order.py internal error: " + ex_str
         }), 500
 
-def processPlaceOrder(user_id, voucher_id=None, voucher_value=0):
+def processPlaceOrder(user_id, voucher_id=None, voucher_value=0, async_payment=False):
     """ Retrieve cart and process the payment """
 
     print("\n========== Invoking cart microservice to retrieve the cart ==========")
@@ -74,28 +112,34 @@ def processPlaceOrder(user_id, voucher_id=None, voucher_value=0):
         }
 
     updated_cart = cart_result.get("cart")
-    total_price = cart_result.get("total_price")
+    # Charge from the cart's running total in exact cents, not a float sum of the lines
+    total_cents = cart_result["totals"]["subtotal_cents"]
 
     # Apply voucher discount if provided
     if voucher_value and float(voucher_value) > 0:
-        original_price = total_price
+        original_cents = total_cents
         # Ensure total price doesn't go below zero
-        total_price = max(total_price - float(voucher_value), 0)
+        total_cents = max(total_cents - round(float(voucher_value) * 100), 0)
         print(f"\n========== Applying voucher discount: ${voucher_value} ==========")
-        print(f"Original price: ${original_price}, Discounted price: ${total_price}")
+        print(f"Original price: ${original_cents / 100:.2f}, Discounted price: ${total_cents / 100:.2f}")
 
     payment_payload = {
         "userID": user_id,
-        "amount": total_price,
+        "amount": total_cents / 100,
+        "amountCents": total_cents,
         "currency": "SGD",
-        "cart": updated_cart
+        "cart": updated_cart,
+        "cartTotals": cart_result.get("totals")
     }
 
     # Add voucher information to payment payload if provided
     if voucher_id:
         payment_payload["voucherId"] = voucher_id
         payment_payload["voucherValue"] = voucher_value
-        payment_payload["originalAmount"] = cart_result.get("total_price")  # Store original amount for reference
+        payment_payload["originalAmount"] = cart_result["totals"]["subtotal_cents"] / 100  # Store original amount for reference
+
+    if async_payment:
+        payment_payload["async"] = True
 
     print("\n========== Invoking the Payment Microservice ==========")
     payment_result = invoke_http(PAYMENT_SERVICE_URL, method='POST', json=payment_payload)
@@ -106,6 +150,13 @@ def processPlaceOrder(user_id, voucher_id=None, voucher_value=0):
             "order_details": updated_cart,
             "payment_details": payment_result
         }
+    elif payment_result.get("pendingID"):
+        return {
+            "code": 202,
+            "message": "Creating payment session",
+            "order_details": updated_cart,
+            "payment_details": payment_result
+        }
     else:
         return {
             "code": 500,
@@ -117,6 +168,53 @@ def processPlaceOrder(user_id, voucher_id=None, voucher_value=0):
 
 
 
+def declare_retry_queues():
+    connection, channel = rabbit.connect(RABBITMQ_HOST, RABBITMQ_PORT, PAYMENT_EXCHANGE_NAME, "topic")
+    channel.queue_declare(queue=PAYMENT_RETRY_QUEUE_NAME, durable=True, arguments={
+        "x-message-ttl": RETRY_DELAY_MS,
+        "x-dead-letter-exchange": "",
+        "x-dead-letter-routing-key": PAYMENT_QUEUE_NAME,
+    })
+    channel.queue_declare(queue=PAYMENT_PARKING_QUEUE_NAME, durable=True)
+    rabbit.close(connection, channel)
+
+
+def retry_later(ch, method, properties, body, reason, count_attempt=True):
+    """
+    Sends a payment message back round through the retry queue, or parks it once it
+    has failed MAX_DELIVERY_ATTEMPTS times. A paid order is never dropped: the
+    original is only acked once the broker has confirmed the copy, and is requeued
+    if that publish fails. Waiting on another consumer's claim doesn't use up an attempt.
+    """
+    headers = dict(properties.headers or {})
+    attempts = headers.get(ATTEMPTS_HEADER, 1)
+    if count_attempt:
+        attempts += 1
+    headers[ATTEMPTS_HEADER] = attempts
+
+    if attempts > MAX_DELIVERY_ATTEMPTS:
+        target = PAYMENT_PARKING_QUEUE_NAME
+        headers["x-failure-reason"] = str(reason)
+        print(f"Parking payment message after {MAX_DELIVERY_ATTEMPTS} attempts: {reason}")
+    else:
+        target = PAYMENT_RETRY_QUEUE_NAME
+        print(f"Retrying payment message in {RETRY_DELAY_MS // 1000}s (attempt {attempts}/{MAX_DELIVERY_ATTEMPTS}): {reason}")
+
+    try:
+        rabbit.get_publisher(RABBITMQ_HOST, RABBITMQ_PORT, confirm=True).publish(
+            "",
+            "direct",
+            target,
+            body,
+            properties=pika.BasicProperties(delivery_mode=2, content_type=properties.content_type, headers=headers)
+        ).result(timeout=PUBLISH_CONFIRM_TIMEOUT)
+    except Exception as e:
+        print(f"Could not move payment message to {target}, requeueing it: {e}")
+        ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+        return
+    ch.basic_ack(delivery_tag=method.delivery_tag)
+
+
 def callback(ch, method, properties, body):
     """Process messages from RabbitMQ."""
     message = json.loads(body)
@@ -125,69 +223,106 @@ def callback(ch, method, properties, body):
     user_id = message.get("userID")
 
     print(f"Received message from {PAYMENT_QUEUE_NAME}: {message}")
-    print(f"Message contents: {json.dumps(message, indent=2)}")  # Add this line to debug
-
-    if status == "successful":
-        # Retrieve cart details from the service
-        cart_result = invoke_http(f"{CART_SERVICE_URL}/{int(user_id)}", method="GET")
-        if not cart_result or cart_result.get("code") != 200 or not cart_result.get("cart"):
-            print("Failed to retrieve cart for reducing stock")
-            return
-        
-        user_details = invoke_http(f"{USER_SERVICE_URL}/{int(user_id)}", method="GET")
-        if not user_details:
-            print("Failed to retrieve user details")
-            return
 
-        updated_cart = cart_result.get("cart")
+    if status != "successful" or not payment_id:
+        print(f"Nothing to fulfil for payment {payment_id} with status {status}")
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+        return
+
+    # Stripe retries and broker redeliveries of a payment we've already handled stop here
+    try:
+        claim = processed_payments.claim(payment_id)
+    except Exception as e:
+        print(f"Could not check processed payments for {payment_id}: {e}")
+        retry_later(ch, method, properties, body, e)
+        return
+    if claim == ALREADY_PUBLISHED:
+        print(f"Payment {payment_id} already fulfilled, skipping")
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+        return
+    if claim != CLAIMED:
+        # Another consumer holds a live claim; if it has died the claim goes stale and is taken over
+        retry_later(ch, method, properties, body, f"payment {payment_id} is being fulfilled elsewhere", count_attempt=False)
+        return
+
+    try:
+        if message.get("cart"):
+            # Fulfil from the cart snapshot stored with the payment at checkout
+            updated_cart = message["cart"]
+            cart_totals = message.get("cartTotals")
+            user_details = invoke_http(f"{USER_SERVICE_URL}/{int(user_id)}", method="GET")
+        else:
+            # Older payment messages carry no snapshot; retrieve cart and user details concurrently
+            cart_result, user_details = invoke_many([
+                {"url": f"{CART_SERVICE_URL}/{int(user_id)}", "method": "GET"},
+                {"url": f"{USER_SERVICE_URL}/{int(user_id)}", "method": "GET"},
+            ])
+            if not cart_result or cart_result.get("code") != 200 or not cart_result.get("cart"):
+                raise Exception(f"Failed to retrieve cart for reducing stock: {cart_result}")
+            updated_cart = cart_result.get("cart")
+            cart_totals = cart_result.get("totals")
+
+        if not user_details or ("code" in user_details and user_details["code"] not in range(200, 300)):
+            raise Exception(f"Failed to retrieve user details: {user_details}")
         
         product_message = [
             {"productId": int(product["productId"]), "stock": int(product["quantity"])}
             for product in updated_cart.values()
             ]
-        try:
-            # Publish fanout message
-            print(f"Publishing message to fanout for user {user_id}")
-            connection, channel = rabbit.connect(RABBITMQ_HOST, RABBITMQ_PORT, PLACE_ORDER_EXCHANGE_NAME, "fanout")
-
-            # Include voucher information in the message if it was in the original payment
-            voucher_info = {}
-            
-            # Check for voucher information in the message
-            if "voucherId" in message:
-                print(f"Found voucher info in message: voucherId={message.get('voucherId')}")
-                voucher_info = {
-                    "voucherId": message.get("voucherId"),
-                    "voucherValue": message.get("voucherValue"),
-                    "originalAmount": message.get("originalAmount")
-                }
-                print(f"Prepared voucher_info: {voucher_info}")
-            
-            # Create the message payload
-            payload = {
-                "message": "complete transaction", 
-                "payment_id": payment_id, 
-                "products": product_message, 
-                "user_details": user_details, 
-                "cart": updated_cart,
-                "voucher_info": voucher_info
+
+        # Publish fanout message
+        print(f"Publishing message to fanout for user {user_id}")
+
+        # Include voucher information in the message if it was in the original payment
+        voucher_info = {}
+        
+        # Check for voucher information in the message
+        if "voucherId" in message:
+            print(f"Found voucher info in message: voucherId={message.get('voucherId')}")
+            voucher_info = {
+                "voucherId": message.get("voucherId"),
+                "voucherValue": message.get("voucherValue"),
+                "originalAmount": message.get("originalAmount")
             }
-            
-            print(f"Publishing message with payload: {json.dumps(payload, indent=2)}")
-            
-            rabbit.publish_message(
-                channel, 
-                PLACE_ORDER_EXCHANGE_NAME,
-                "", 
-                payload
-            )
-
-            rabbit.close(connection, channel)
-            print("======= Fanout Message Published =======")
-        except Exception as e:
-            print(f"Error publishing messages: {e}")
-        finally:
-            ch.basic_ack(delivery_tag=method.delivery_tag)
+            print(f"Prepared voucher_info: {voucher_info}")
+        
+        # Create the message payload
+        payload = {
+            "message": "complete transaction", 
+            "payment_id": payment_id, 
+            "products": product_message, 
+            "user_details": user_details, 
+            "cart": updated_cart,
+            "cart_totals": cart_totals,
+            "voucher_info": voucher_info
+        }
+        
+        print(f"Publishing message with payload: {json.dumps(payload, indent=2)}")
+        
+        # Wait for the broker to confirm the fanout on the shared publisher connection
+        rabbit.get_publisher(RABBITMQ_HOST, RABBITMQ_PORT, confirm=True).publish(
+            PLACE_ORDER_EXCHANGE_NAME,
+            "fanout",
+            "", 
+            payload
+        ).result(timeout=PUBLISH_CONFIRM_TIMEOUT)
+    except Exception as e:
+        print(f"Error fulfilling payment {payment_id}: {e}")
+        try:
+            processed_payments.release(payment_id)
+        except Exception as release_error:
+            # The claim goes stale after CLAIM_TIMEOUT and is taken over by the retry
+            print(f"Could not release claim on payment {payment_id}: {release_error}")
+        retry_later(ch, method, properties, body, e)
+        return
+
+    print("======= Fanout Message Published =======")
+    try:
+        processed_payments.mark_published(payment_id)
+    except Exception as e:
+        # The claim stays 'processing' and goes stale, so a late duplicate could still re-run it
+        print(f"Could not mark payment {payment_id} as published: {e}")
+    ch.basic_ack(delivery_tag=method.delivery_tag)
 
 
 def run_flask_app():
@@ -202,5 +337,7 @@ if __name__ == '__main__':
 
     #is redundancy 
     rabbit.connect(RABBITMQ_HOST,RABBITMQ_PORT,PAYMENT_EXCHANGE_NAME,"topic",{PAYMENT_QUEUE_NAME:PAYMENT_ROUTING_KEY})
+    declare_retry_queues()
 
-    rabbit.start_consuming(RABBITMQ_HOST, RABBITMQ_PORT, PAYMENT_EXCHANGE_NAME,"topic",PAYMENT_QUEUE_NAME, callback=callback)
\ No newline at end of file
+    rabbit.start_consuming(RABBITMQ_HOST, RABBITMQ_PORT, PAYMENT_EXCHANGE_NAME,"topic",PAYMENT_QUEUE_NAME, callback=callback,
+                           prefetch_count=CONSUMER_PREFETCH, workers=CONSUMER_WORKERS)
\ No newline at end of file
@@ -0,0 +1,111 @@
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from utils.supabase import get_supabase
+
+# Payments whose fanout has been published (or is being published), keyed by Stripe session id:
+#
+#   create table processed_payments (
+#       payment_id text primary key,
+#       status text not null default 'processing',  -- 'processing' | 'published'
+#       claimed_at timestamptz not null default now()
+#   );
+PROCESSED_PAYMENTS_TABLE = "processed_payments"
+
+PROCESSING = "processing"
+PUBLISHED = "published"
+
+# Outcomes of claim()
+CLAIMED = "claimed"
+ALREADY_PUBLISHED = "already_published"
+IN_PROGRESS = "in_progress"
+
+# A 'processing' claim older than this is assumed to belong to a consumer that died
+CLAIM_TIMEOUT = 300
+
+# Published payment ids remembered in memory, so most duplicates skip the database
+RECENT_PAYMENTS_SIZE = 10000
+
+
+class ProcessedPayments:
+    """
+    Deduplicates payment-success messages on paymentID.
+
+    A consumer claims a payment before fulfilling it and marks it published once
+    the fanout is confirmed by the broker. Redeliveries and Stripe retries of a
+    published payment are answered from memory (or one primary-key lookup). A
+    duplicate arriving while another consumer's claim is still live gets
+    IN_PROGRESS and should be retried later, not dropped: the claim goes stale
+    after claim_timeout if that consumer died, and is then taken over.
+    """
+
+    def __init__(self, supabase=None, claim_timeout=CLAIM_TIMEOUT, recent_size=RECENT_PAYMENTS_SIZE):
+        self.supabase = supabase or get_supabase()
+        self.claim_timeout = claim_timeout
+        self.recent_size = recent_size
+        self._recent = OrderedDict()
+        self._lock = threading.Lock()
+
+    def is_published(self, payment_id):
+        with self._lock:
+            if payment_id in self._recent:
+                return True
+        response = self.supabase.table(PROCESSED_PAYMENTS_TABLE).select("status").eq("payment_id", payment_id).execute()
+        if response.data and response.data[0]["status"] == PUBLISHED:
+            self._remember(payment_id)
+            return True
+        return False
+
+    def claim(self, payment_id):
+        """ Returns CLAIMED if this consumer should fulfil the payment, else ALREADY_PUBLISHED or IN_PROGRESS """
+        if self.is_published(payment_id):
+            return ALREADY_PUBLISHED
+
+        now = datetime.now(timezone.utc)
+        try:
+            self.supabase.table(PROCESSED_PAYMENTS_TABLE).insert({
+                "payment_id": payment_id,
+                "status": PROCESSING,
+                "claimed_at": now.isoformat()
+            }).execute()
+            return CLAIMED
+        except Exception:
+            # Already claimed; take it over only if the claim is stale
+            pass
+
+        response = self.supabase.table(PROCESSED_PAYMENTS_TABLE).select("*").eq("payment_id", payment_id).execute()
+        if not response.data:
+            # The claim was released between our insert and read
+            return IN_PROGRESS
+        row = response.data[0]
+        if row["status"] == PUBLISHED:
+            self._remember(payment_id)
+            return ALREADY_PUBLISHED
+        if datetime.fromisoformat(row["claimed_at"]) > now - timedelta(seconds=self.claim_timeout):
+            return IN_PROGRESS
+
+        # Compare-and-set on claimed_at so only one consumer takes over
+        takeover = (
+            self.supabase.table(PROCESSED_PAYMENTS_TABLE)
+            .update({"claimed_at": now.isoformat()})
+            .eq("payment_id", payment_id)
+            .eq("status", PROCESSING)
+            .eq("claimed_at", row["claimed_at"])
+            .execute()
+        )
+        return CLAIMED if takeover.data else IN_PROGRESS
+
+    def mark_published(self, payment_id):
+        self.supabase.table(PROCESSED_PAYMENTS_TABLE).update({"status": PUBLISHED}).eq("payment_id", payment_id).execute()
+        self._remember(payment_id)
+
+    def release(self, payment_id):
+        """ Gives up a claim so a redelivery can try again """
+        self.supabase.table(PROCESSED_PAYMENTS_TABLE).delete().eq("payment_id", payment_id).eq("status", PROCESSING).execute()
+
+    def _remember(self, payment_id):
+        with self._lock:
+            self._recent[payment_id] = True
+            self._recent.move_to_end(payment_id)
+            while len(self._recent) > self.recent_size:
+                self._recent.popitem(last=False)
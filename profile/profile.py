@@ -39,22 +39,13 @@ def create_user():
             'email': email
         }).execute()
 
-        # Establish connection to RabbitMQ
-        connection, channel = rabbit.connect(
-            RABBITMQ_HOST, 
-            RABBITMQ_PORT, 
-            NOTIF_EXCHANGE_NAME, 
-            "topic"
-        )
-        
-        rabbit.publish_message(
-            channel, 
+        # Publish over the pooled RabbitMQ connection
+        rabbit.get_publisher(RABBITMQ_HOST, RABBITMQ_PORT).publish(
             NOTIF_EXCHANGE_NAME, 
+            "topic",
             "email.welcome", 
             {'email': email, 'name': name}
         )
-
-        connection.close()
         
         log.info(f"User {email} created successfully.")
         return jsonify({"status_code": 200, "status": "success", "message": "User created successfully"}), 200
@@ -0,0 +1,96 @@
+import math
+import heapq
+import threading
+import time
+import logging
+from datetime import datetime, timezone
+
+# Neighbours kept per product, and how often the model is rebuilt from user_purchases
+NEIGHBOURS_PER_PRODUCT = 20
+REFRESH_INTERVAL = 3600
+
+
+class CoPurchaseModel:
+    """
+    "Customers who bought X also bought Y", built from the product lists in user_purchases.
+
+    build() counts how often every pair of products appears in the same purchase
+    (a sparse item-item co-occurrence matrix held as {productId: {productId: count}}),
+    scores each pair with cosine similarity and keeps the top neighbours per
+    product. Lookups only touch the neighbour lists of the products asked about.
+    """
+
+    def __init__(self, neighbours_per_product=NEIGHBOURS_PER_PRODUCT):
+        self.neighbours_per_product = neighbours_per_product
+        self.built_at = None
+        self._neighbours = {}  # productId -> [(productId, score), ...], best first
+
+    def build(self, purchases):
+        """
+        Rebuilds the model from an iterable of purchases (each a list of products).
+        """
+        purchase_counts = {}
+        co_counts = {}
+        for products in purchases:
+            product_ids = sorted({int(product["productId"]) for product in products if product.get("productId")})
+            for product_id in product_ids:
+                purchase_counts[product_id] = purchase_counts.get(product_id, 0) + 1
+            for i, product_id in enumerate(product_ids):
+                row = co_counts.setdefault(product_id, {})
+                for other_id in product_ids[i + 1:]:
+                    row[other_id] = row.get(other_id, 0) + 1
+
+        # Score both directions of every pair, then keep the best neighbours per product
+        scored = {}
+        for product_id, row in co_counts.items():
+            for other_id, count in row.items():
+                score = count / math.sqrt(purchase_counts[product_id] * purchase_counts[other_id])
+                scored.setdefault(product_id, []).append((other_id, score))
+                scored.setdefault(other_id, []).append((product_id, score))
+
+        neighbours = {
+            product_id: heapq.nlargest(self.neighbours_per_product, candidates, key=lambda x: x[1])
+            for product_id, candidates in scored.items()
+        }
+
+        # Swap in the new lists in one assignment so readers never see a half-built model
+        self._neighbours = neighbours
+        self.built_at = datetime.now(timezone.utc).isoformat()
+        return len(neighbours)
+
+    def neighbours(self, product_id):
+        return list(self._neighbours.get(int(product_id), []))
+
+    def also_bought(self, product_ids, k, exclude=()):
+        """
+        Returns up to k productIds most often bought with any of product_ids, best
+        first, summing scores across the given products. O(len(product_ids)).
+        """
+        neighbours = self._neighbours
+        exclude = set(exclude) | {int(product_id) for product_id in product_ids}
+        scores = {}
+        for product_id in product_ids:
+            for other_id, score in neighbours.get(int(product_id), []):
+                if other_id not in exclude:
+                    scores[other_id] = scores.get(other_id, 0) + score
+        return [product_id for product_id, _ in heapq.nlargest(k, scores.items(), key=lambda x: x[1])]
+
+
+def start_refresh(model, load_purchases, interval=REFRESH_INTERVAL):
+    """
+    Builds the model now and then every `interval` seconds on a daemon thread.
+    load_purchases() returns an iterable of purchases (lists of products).
+    """
+    def run():
+        while True:
+            try:
+                started = time.monotonic()
+                products = model.build(load_purchases())
+                print(f"Co-purchase model rebuilt for {products} products in {time.monotonic() - started:.1f}s")
+            except Exception as e:
+                logging.error(f"Co-purchase model rebuild failed: {e}")
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
@@ -1,11 +1,18 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from supabase import create_client, Client
 from dotenv import load_dotenv
+from datetime import datetime, timezone
 import threading
 import os
-import random
+import sys
 import json
-from utils.invokes import invoke_http  # Your HTTP utility function
+import zlib
+import numpy as np
+from utils.invokes import invoke_http, invoke_http_async, invoke_many  # Your HTTP utility function
+from utils.product_cache import get_catalogue
+from scoring import get_scoring_engine
+from co_purchase import CoPurchaseModel, start_refresh
+from result_cache import RecommendationCache
 import utils.amqp_lib as rabbit
 from utils.cors_config import enable_cors
 
@@ -26,90 +33,304 @@ supabase_url = os.getenv("SUPABASE_URL")
 supabase_key = os.getenv("SUPABASE_KEY")
 supabase: Client = create_client(supabase_url, supabase_key)
 
-# External API endpoint for fetching all products
-PRODUCTS_API_URL = "https://personal-o2kymv2n.outsystemscloud.com/SustainaMart/rest/v1/allproducts/"
-
-# External API endpoint for fetching single product details
-SINGLE_API_URL = "https://personal-o2kymv2n.outsystemscloud.com/SustainaMart/rest/v1/products/{productid}/"\
-
 # External API endpoint for fetching cart details to compare
 CART_API_URL = "http://cart:5201/cart/{user_id}"
 
-# Function to get user TagClass preferences based on quantity purchased
-def get_user_tags(user_id):
-    response = supabase.table('user_purchases').select('products').eq('user_id', user_id).execute()
-    purchases = response.data
+# Number of products returned per recommendation request
+RECOMMENDATION_COUNT = 3
+
+# Users looked up together (one affinity query, concurrent cart fetches) by the batch endpoint
+BATCH_CHUNK_SIZE = 100
+
+# Materialised TagClass quantities per user, kept up to date as purchases are recorded
+# so recommendations read one row instead of the whole purchase history:
+#
+#   create table user_tag_affinity (
+#       user_id bigint primary key,
+#       tag_counts jsonb not null default '{}'::jsonb,   -- {TagClass: quantity bought}
+#       ranked_tags jsonb not null default '[]'::jsonb,  -- TagClasses, most bought first
+#       updated_at timestamptz not null default now()
+#   );
+AFFINITY_TABLE = "user_tag_affinity"
+
+# Computed recommendations per (user, day or session), dropped when the user's purchases or cart change
+result_cache = RecommendationCache()
+
+# "Customers who bought X also bought Y", rebuilt periodically from user_purchases
+co_purchase_model = CoPurchaseModel()
+
+# Serialises affinity writes within this process (the purchase consumer and the API's
+# lazy rebuilds). It does not cover the backfill-affinity command, which runs as a
+# separate process; see backfill_user_tag_affinity.
+affinity_lock = threading.Lock()
+
+def count_tags(products, tag_counts=None):
+    """ Adds the TagClass quantities of purchased products onto tag_counts """
+    tag_counts = dict(tag_counts or {})
+    for product in products:
+        tag = product['TagClass']
+        quantity = product.get('quantity', 1)  # Default to 1 if quantity is missing
+        tag_counts[tag] = tag_counts.get(tag, 0) + quantity
+    return tag_counts
+
+def affinity_row(user_id, tag_counts):
+    sorted_tags = sorted(tag_counts.items(), key=lambda x: x[1], reverse=True)
+    return {
+        'user_id': user_id,
+        'tag_counts': tag_counts,
+        'ranked_tags': [tag for tag, _ in sorted_tags],
+        'updated_at': datetime.now(timezone.utc).isoformat()
+    }
+
+def update_user_tag_affinity(user_id, products):
+    """ Folds newly purchased products into the user's affinity row; the caller holds affinity_lock """
+    response = supabase.table(AFFINITY_TABLE).select('tag_counts').eq('user_id', user_id).execute()
+    if response.data:
+        tag_counts = count_tags(products, response.data[0]['tag_counts'])
+        supabase.table(AFFINITY_TABLE).upsert(affinity_row(user_id, tag_counts)).execute()
+    else:
+        # First affinity write for this user, build it from the full history (which includes these products)
+        rebuild_user_tag_affinity(user_id)
 
+def rebuild_user_tag_affinity(user_id):
+    """ Recomputes one user's affinity row from user_purchases """
+    response = supabase.table('user_purchases').select('products').eq('user_id', user_id).execute()
     tag_counts = {}
-    for purchase in purchases:
-        for product in purchase['products']:
-            tag = product['TagClass']
-            quantity = product.get('quantity', 1)  # Default to 1 if quantity is missing
-            tag_counts[tag] = tag_counts.get(tag, 0) + quantity
-
-    sorted_tags = sorted(tag_counts.items(), key=lambda x: x[1], reverse=True)
-    return [tag for tag, _ in sorted_tags]
+    for purchase in response.data:
+        tag_counts = count_tags(purchase['products'], tag_counts)
+
+    if tag_counts:
+        supabase.table(AFFINITY_TABLE).upsert(affinity_row(user_id, tag_counts)).execute()
+    return tag_counts
+
+def iter_user_purchases(columns='user_id, products', page_size=1000, user_ids=None):
+    """ Pages through every row of user_purchases, or just those of user_ids """
+    start = 0
+    while True:
+        query = supabase.table('user_purchases').select(columns)
+        if user_ids is not None:
+            query = query.in_('user_id', list(user_ids))
+        rows = query.range(start, start + page_size - 1).execute().data
+        yield from rows
+        if len(rows) < page_size:
+            break
+        start += page_size
+
+def backfill_user_tag_affinity(page_size=1000):
+    """
+    Rebuilds user_tag_affinity for every user from user_purchases.
+
+    Run it with the recommendation service stopped: it upserts whole rows computed
+    from an earlier read, so a purchase merged by the consumer in the meantime would
+    be overwritten. Purchase messages queue up in RabbitMQ until the service is back.
+    """
+    print("====== BACKFILLING USER TAG AFFINITY ======")
+    tag_counts_by_user = {}
+    for row in iter_user_purchases(page_size=page_size):
+        user_id = row['user_id']
+        tag_counts_by_user[user_id] = count_tags(row['products'], tag_counts_by_user.get(user_id))
+
+    rows = [affinity_row(user_id, tag_counts) for user_id, tag_counts in tag_counts_by_user.items()]
+    for i in range(0, len(rows), page_size):
+        supabase.table(AFFINITY_TABLE).upsert(rows[i:i + page_size]).execute()
+    print(f"Backfilled tag affinity for {len(rows)} users")
+
+# Function to get user TagClass preferences ({TagClass: quantity purchased})
+def get_user_tag_counts(user_id):
+    response = supabase.table(AFFINITY_TABLE).select('tag_counts').eq('user_id', user_id).execute()
+    if response.data:
+        return response.data[0]['tag_counts']
+
+    # Not materialised yet (e.g. before the backfill has run)
+    with affinity_lock:
+        return rebuild_user_tag_affinity(user_id)
+
+def get_user_tag_counts_many(user_ids):
+    """ Returns {user_id: tag_counts} for several users with one query """
+    response = supabase.table(AFFINITY_TABLE).select('user_id, tag_counts').in_('user_id', list(user_ids)).execute()
+    tag_counts_by_user = {row['user_id']: row['tag_counts'] for row in response.data}
+    missing = [user_id for user_id in user_ids if user_id not in tag_counts_by_user]
+    if missing:
+        tag_counts_by_user.update(rebuild_user_tag_affinity_many(missing))
+    return tag_counts_by_user
+
+def rebuild_user_tag_affinity_many(user_ids):
+    """ Recomputes several users' affinity rows from one user_purchases query """
+    with affinity_lock:
+        tag_counts_by_user = {user_id: {} for user_id in user_ids}
+        for row in iter_user_purchases(user_ids=user_ids):
+            user_id = row['user_id']
+            tag_counts_by_user[user_id] = count_tags(row['products'], tag_counts_by_user.get(user_id))
+
+        rows = [affinity_row(user_id, tag_counts) for user_id, tag_counts in tag_counts_by_user.items() if tag_counts]
+        if rows:
+            supabase.table(AFFINITY_TABLE).upsert(rows).execute()
+    return tag_counts_by_user
 
 # API to record user purchase (after payment)
+def save_purchase(user_id, products):
+    """ Inserts a purchase row and folds it into the user's tag affinity """
+    # Held across the insert and the merge, so a lazy rebuild can't read the new
+    # purchase in between and have it counted twice
+    with affinity_lock:
+        response = supabase.table('user_purchases').insert({
+            'user_id': user_id,
+            'products': products
+        }).execute()
+
+        if not response.data:
+            return False
+        update_user_tag_affinity(user_id, products)
+    result_cache.invalidate(int(user_id))
+    return True
+
 @app.route('/purchase', methods=['POST'])
 def record_purchase():
     data = request.json
     user_id = data['user_id']
     products = data['products']
 
-    response = supabase.table('user_purchases').insert({
-        'user_id': user_id,
-        'products': products
-    }).execute()
-
-    if response.data:
+    if save_purchase(user_id, products):
         return jsonify({"message": "Purchase recorded successfully.", "status": "success", "code": 201, "user_id": user_id, "products": products}), 201
     else:
         return jsonify({"message": "Failed to record purchase", "status": "error", "code": 400}), 400
 
-# API to get recommendations for a user
+def get_seed_key(session=None):
+    """ Recommendations stay the same for a session, or for the day when no session is given """
+    return session or datetime.now(timezone.utc).date().isoformat()
+
+def seeded_rng(user_id, seed_key):
+    return np.random.default_rng(zlib.crc32(f"{user_id}:{seed_key}".encode()))
+
+# API to get recommendations for a user (?session=<id> to vary them per session instead of per day)
 @app.route('/recommendations/<int:user_id>', methods=['GET'])
 def get_recommendations(user_id):
+    seed_key = get_seed_key(request.args.get('session'))
+    cached = result_cache.get(user_id, seed_key)
+    if cached is not None:
+        return jsonify(cached), cached["code"]
+
+    result = compute_recommendations(user_id, seed_key)
+    if result["code"] == 200:
+        result_cache.put(user_id, seed_key, result)
+    return jsonify(result), result["code"]
+
+def compute_recommendations(user_id, seed_key):
     # Step 1: Get user's preferred tags
-    user_tags = get_user_tags(user_id)
-    if not user_tags:
-        return jsonify({"message": "No recommendations available.", "status": "info", "code": 200}), 200
+    tag_counts = get_user_tag_counts(user_id)
+    if not tag_counts:
+        return {"message": "No recommendations available.", "status": "info", "code": 200}
 
-    # Step 2: Fetch all products
-    products_response = invoke_http(PRODUCTS_API_URL, "GET")
-    if 'code' in products_response and products_response['code'] != 200:
-        return jsonify({"message": f"Error fetching products: {products_response.get('message', 'Unknown error')}", "status": "error", "code": 500}), 500
+    # Step 2: Fetch the user's cart while the scoring engine is brought up to date
+    cart_future = invoke_http_async(CART_API_URL.format(user_id=user_id), "GET")
 
-    all_products = products_response.get('Products', [])
+    engine = get_scoring_engine()
+    if engine is None:
+        return {"message": "Error fetching products: product catalogue unavailable", "status": "error", "code": 500}
 
-    # Step 3: Fetch user's cart
-    cart_response = invoke_http(CART_API_URL.format(user_id=user_id), "GET")
+    # Steps 3 and 4: Check user's cart and rank products
+    return rank_for_user(engine, tag_counts, cart_future.result(), seeded_rng(user_id, seed_key))
+
+def rank_for_user(engine, tag_counts, cart_response, rng):
+    """ Builds a user's recommendation response body from their tag counts and cart """
     if 'code' in cart_response and cart_response['code'] != 200:
-        return jsonify({"message": f"Error fetching cart: {cart_response.get('message', 'Unknown error')}", "status": "error", "code": 500}), 500
+        return {"message": f"Error fetching cart: {cart_response.get('message', 'Unknown error')}", "status": "error", "code": 500}
 
     cart_items = cart_response.get('cart', {})
     cart_product_ids = {int(item.get("productId")) for item in cart_items.values()}
 
-    # Step 4: Filter products based on user tags and exclude cart items
-    recommendations = []
+    # Score every product against the user's tag affinity, excluding cart items
+    recommendations = engine.recommend(tag_counts, RECOMMENDATION_COUNT, exclude=cart_product_ids, rng=rng)
 
-    for tag in user_tags:
-        tag_products = [
-            product for product in all_products
-            if product['TagClass'] == tag and int(product['productId']) not in cart_product_ids
-        ]
-        random.shuffle(tag_products)
-        recommendations.extend(tag_products)
-        if len(recommendations) >= 3:
-            break
+    if not recommendations:
+        return {"message": "No recommendations found for the user.", "status": "info", "code": 200}
 
-    recommendations = recommendations[:3]  # Ensure no more than 3 are returned
+    return {"recommendations": recommendations, "status": "success", "code": 200}
 
+# API to get recommendations for many users at once, streamed back as one JSON line per user
+#   request:  {"user_ids": [1, 2, 3], "session": "optional session id"}
+#   response: {"user_id": 1, "recommendations": [...], "status": "success", "code": 200}\n...
+@app.route('/recommendations/batch', methods=['POST'])
+def get_recommendations_batch():
+    data = request.json or {}
+    user_ids = data.get('user_ids')
+    try:
+        user_ids = [int(user_id) for user_id in user_ids] if isinstance(user_ids, list) else None
+    except (TypeError, ValueError):
+        user_ids = None
+    if not user_ids:
+        return jsonify({"message": "user_ids must be a non-empty list of user ids.", "status": "error", "code": 400}), 400
+
+    # Catalogue is checked once for the whole batch
+    engine = get_scoring_engine()
+    if engine is None:
+        return jsonify({"message": "Error fetching products: product catalogue unavailable", "status": "error", "code": 500}), 500
+
+    seed_key = get_seed_key(data.get('session'))
+
+    def generate():
+        for start in range(0, len(user_ids), BATCH_CHUNK_SIZE):
+            chunk = user_ids[start:start + BATCH_CHUNK_SIZE]
+            results = {user_id: result_cache.get(user_id, seed_key) for user_id in chunk}
+            uncached = [user_id for user_id in chunk if results[user_id] is None]
+
+            if uncached:
+                tag_counts_by_user = get_user_tag_counts_many(uncached)
+
+                # Only users with purchase history need their cart
+                users_with_tags = [user_id for user_id in uncached if tag_counts_by_user.get(user_id)]
+                cart_responses = invoke_many([{"url": CART_API_URL.format(user_id=user_id), "method": "GET"} for user_id in users_with_tags])
+                carts = dict(zip(users_with_tags, cart_responses))
+
+                for user_id in uncached:
+                    if user_id in carts:
+                        result = rank_for_user(engine, tag_counts_by_user[user_id], carts[user_id], seeded_rng(user_id, seed_key))
+                    else:
+                        result = {"message": "No recommendations available.", "status": "info", "code": 200}
+                    if result["code"] == 200:
+                        result_cache.put(user_id, seed_key, result)
+                    results[user_id] = result
+
+            for user_id in chunk:
+                yield json.dumps({"user_id": user_id, **results[user_id]}) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+# API for other services to drop a user's cached recommendations (e.g. when their cart changes)
+@app.route('/recommendations/cache/<int:user_id>', methods=['DELETE'])
+def invalidate_recommendations(user_id):
+    result_cache.invalidate(user_id)
+    return jsonify({"message": "Recommendation cache cleared.", "status": "success", "code": 200}), 200
+
+
+def also_bought_products(product_ids, exclude=()):
+    """ Resolves the co-purchase neighbours of product_ids to full product details, best first """
+    neighbour_ids = co_purchase_model.also_bought(product_ids, RECOMMENDATION_COUNT, exclude=exclude)
+    products = get_catalogue().get_many(neighbour_ids)
+    return [products[product_id] for product_id in neighbour_ids if product_id in products]
+
+# API to get products often bought together with what's in the user's cart
+@app.route('/recommendations/<int:user_id>/also-bought', methods=['GET'])
+def get_cart_also_bought(user_id):
+    cart_response = invoke_http(CART_API_URL.format(user_id=user_id), "GET")
+    if 'code' in cart_response and cart_response['code'] != 200:
+        return jsonify({"message": f"Error fetching cart: {cart_response.get('message', 'Unknown error')}", "status": "error", "code": 500}), 500
+
+    cart_product_ids = [int(item.get("productId")) for item in cart_response.get('cart', {}).values()]
+    recommendations = also_bought_products(cart_product_ids)
     if not recommendations:
         return jsonify({"message": "No recommendations found for the user.", "status": "info", "code": 200}), 200
 
     return jsonify({"recommendations": recommendations, "status": "success", "code": 200}), 200
 
+# API to get products often bought together with one product
+@app.route('/recommendations/product/<int:product_id>/also-bought', methods=['GET'])
+def get_product_also_bought(product_id):
+    recommendations = also_bought_products([product_id])
+    if not recommendations:
+        return jsonify({"message": "No recommendations found for the product.", "status": "info", "code": 200}), 200
+
+    return jsonify({"recommendations": recommendations, "status": "success", "code": 200}), 200
 
 
 def callback(ch, method, properties, body):
@@ -126,21 +347,23 @@ def callback(ch, method, properties, body):
             ch.basic_ack(delivery_tag=method.delivery_tag)
             return
 
-        full_products = []
-        for product in products:
-            product_id = product.get("productId")
-            quantity = product.get("stock")  # 'stock' represents quantity bought
-
-            if not product_id or quantity is None:
-                continue
+        # 'stock' represents quantity bought
+        purchased = [
+            (product.get("productId"), product.get("stock"))
+            for product in products
+            if product.get("productId") and product.get("stock") is not None
+        ]
 
-            # Fetch full product details
-            product_details = invoke_http(SINGLE_API_URL.format(productid=product_id), "GET")
+        # Fetch full product details in one pass (cached, missing ones fetched concurrently)
+        product_details = get_catalogue().get_many([product_id for product_id, _ in purchased])
 
-            if not product_details.get("Result", {}).get("Success", False):
+        full_products = []
+        for product_id, quantity in purchased:
+            product_info = product_details.get(int(product_id))
+            if not product_info:
                 continue
 
-            product_info = product_details.get("Product", {})
+            product_info = dict(product_info)
             product_info["quantity"] = quantity  # Add quantity to product details
             full_products.append(product_info)
 
@@ -149,17 +372,11 @@ def callback(ch, method, properties, body):
             ch.basic_ack(delivery_tag=method.delivery_tag)
             return
 
-        # Construct payload for the /purchase endpoint
-        purchase_data = {
-            "user_id": user_id,
-            "products": full_products
-        }
-
-        # Call the /purchase endpoint
-        purchase_response = invoke_http("http://recommendation:5204/purchase", method="POST", json=purchase_data)
-
-        # Log response
-        print("Recommendation database logging response:", purchase_response)
+        # Record the purchase directly rather than going through our own /purchase endpoint
+        if save_purchase(user_id, full_products):
+            print(f"Recorded purchase of {len(full_products)} product(s) for user {user_id}")
+        else:
+            print(f"Failed to record purchase for user {user_id}")
 
         # Acknowledge the message after processing
         ch.basic_ack(delivery_tag=method.delivery_tag)
@@ -174,6 +391,18 @@ def run_flask_app():
 
 
 if __name__ == '__main__':
+    # `python recommendation.py backfill-affinity` rebuilds user_tag_affinity and exits.
+    # Stop the running recommendation service first (see backfill_user_tag_affinity).
+    if len(sys.argv) > 1 and sys.argv[1] == "backfill-affinity":
+        backfill_user_tag_affinity()
+        sys.exit(0)
+
+    # Warm the product catalogue cache so the first requests don't pay for it
+    get_catalogue().prefetch()
+
+    # Build the co-purchase model in the background and keep it refreshed
+    start_refresh(co_purchase_model, lambda: (row['products'] for row in iter_user_purchases('products')))
+
     # Start the Flask app in a separate thread so it does not block the RabbitMQ consumer
     flask_thread = threading.Thread(target=run_flask_app)
     flask_thread.start()
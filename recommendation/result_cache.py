@@ -0,0 +1,64 @@
+import threading
+import time
+from collections import OrderedDict
+
+# Computed recommendation lists kept per process
+RESULT_CACHE_SIZE = 10000
+RESULT_CACHE_TTL = 600
+
+
+class RecommendationCache:
+    """
+    LRU cache of computed recommendation results with a TTL, keyed by
+    (user_id, seed key). All of a user's entries can be dropped at once when
+    their purchases or cart change.
+    """
+
+    def __init__(self, maxsize=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # (user_id, seed_key) -> (result, stored_at)
+        self._keys_by_user = {}  # user_id -> {seed_key, ...}
+        self._lock = threading.Lock()
+
+    def get(self, user_id, seed_key):
+        key = (user_id, seed_key)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[1] >= self.ttl:
+                if entry is not None:
+                    self._drop(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, user_id, seed_key, result):
+        key = (user_id, seed_key)
+        with self._lock:
+            self._entries[key] = (result, time.monotonic())
+            self._entries.move_to_end(key)
+            self._keys_by_user.setdefault(user_id, set()).add(seed_key)
+            while len(self._entries) > self.maxsize:
+                self._drop(next(iter(self._entries)))
+
+    def invalidate(self, user_id):
+        with self._lock:
+            for seed_key in self._keys_by_user.pop(user_id, ()):
+                self._entries.pop((user_id, seed_key), None)
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+    def _drop(self, key):
+        self._entries.pop(key, None)
+        user_id, seed_key = key
+        seed_keys = self._keys_by_user.get(user_id)
+        if seed_keys is not None:
+            seed_keys.discard(seed_key)
+            if not seed_keys:
+                del self._keys_by_user[user_id]
@@ -0,0 +1,205 @@
+import threading
+import numpy as np
+from utils.product_cache import get_catalogue
+
+# Score weights. Affinity is the share of the user's purchases (by quantity) in the
+# product's TagClass; the other features are scaled to [0, 1] across the catalogue.
+AFFINITY_WEIGHT = 1.0
+SUSTAINABILITY_WEIGHT = 0.3
+PRICE_WEIGHT = 0.1  # cheaper is better
+STOCK_WEIGHT = 0.05  # prefer well stocked products
+
+# Random jitter added to scores when a generator is passed to recommend(), so
+# equally good products don't always come back in the same order
+EXPLORATION_NOISE = 0.05
+
+
+class ScoringEngine:
+    """
+    Holds the product catalogue as NumPy column arrays (one row per product) and
+    ranks products for a user in a single vectorised pass.
+
+    Active rows are also bucketed by TagClass, and only products in a TagClass the
+    user has bought from can score, so a request gathers just the union of the
+    user's buckets instead of the whole catalogue. TagClasses are stored as integer
+    codes, so the user's affinity vector is applied with one gather
+    (affinity[tag_codes]). Rows and buckets are updated in place as catalogue
+    changes arrive; removed products are deactivated and dropped from their bucket.
+    """
+
+    def __init__(self, capacity=1024):
+        self._rows = {}  # productId -> row
+        self._products = []  # row -> product
+        self._tags = {}  # TagClass -> code
+        self._size = 0
+        self._tag_codes = np.zeros(capacity, dtype=np.int32)
+        self._price = np.zeros(capacity)
+        self._points = np.zeros(capacity)
+        self._stock = np.zeros(capacity)
+        self._active = np.zeros(capacity, dtype=bool)
+        self._buckets = {}  # tag code -> [row, ...] of active rows
+        self._bucket_positions = {}  # row -> index in its bucket
+        self._bucket_arrays = {}  # tag code -> bucket as an index array, rebuilt when it changes
+        # Catalogue-wide maxima used to scale features, refreshed on every change
+        self._max_price = 1.0
+        self._max_points = 1.0
+        self._max_log_stock = np.log1p(1.0)
+        self._lock = threading.Lock()
+
+    def apply(self, upserted, removed):
+        """
+        Catalogue listener: applies added/changed products and removed productIds.
+        """
+        with self._lock:
+            for product_id in removed:
+                row = self._rows.get(int(product_id))
+                if row is not None:
+                    self._active[row] = False
+                    self._bucket_remove(row)
+
+            if upserted:
+                rows = []
+                for product in upserted:
+                    product_id = int(product["productId"])
+                    row = self._rows.get(product_id)
+                    if row is None:
+                        row = self._size
+                        self._size += 1
+                        self._rows[product_id] = row
+                        self._products.append(product)
+                    else:
+                        self._products[row] = product
+                        # Its TagClass may change, so it is re-bucketed below
+                        self._bucket_remove(row)
+                    rows.append(row)
+
+                self._grow(self._size)
+                rows = np.array(rows)
+                self._tag_codes[rows] = [self._tags.setdefault(product.get("TagClass"), len(self._tags)) for product in upserted]
+                self._price[rows] = [float(product.get("Price") or 0) for product in upserted]
+                self._points[rows] = [float(product.get("SustainabilityPoints") or 0) for product in upserted]
+                # Products without a Stock field are treated as available
+                self._stock[rows] = [float(product.get("Stock", 1) or 0) for product in upserted]
+                self._active[rows] = True
+                for row in rows.tolist():
+                    if row not in self._bucket_positions:
+                        self._bucket_add(row)
+
+            self._refresh_maxima()
+
+    def _grow(self, size):
+        capacity = len(self._active)
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        for name in ("_tag_codes", "_price", "_points", "_stock", "_active"):
+            column = getattr(self, name)
+            grown = np.zeros(capacity, dtype=column.dtype)
+            grown[:len(column)] = column
+            setattr(self, name, grown)
+
+    def _bucket_add(self, row):
+        code = int(self._tag_codes[row])
+        bucket = self._buckets.setdefault(code, [])
+        self._bucket_positions[row] = len(bucket)
+        bucket.append(row)
+        self._bucket_arrays.pop(code, None)
+
+    def _bucket_remove(self, row):
+        index = self._bucket_positions.pop(row, None)
+        if index is None:
+            return
+        code = int(self._tag_codes[row])
+        bucket = self._buckets[code]
+        # Swap with the last entry so removal doesn't shift the bucket
+        last = bucket.pop()
+        if last != row:
+            bucket[index] = last
+            self._bucket_positions[last] = index
+        self._bucket_arrays.pop(code, None)
+
+    def _bucket_array(self, code):
+        rows = self._bucket_arrays.get(code)
+        if rows is None:
+            rows = np.array(self._buckets.get(code, ()), dtype=np.intp)
+            self._bucket_arrays[code] = rows
+        return rows
+
+    def _refresh_maxima(self):
+        active = self._active[:self._size]
+        if not active.any():
+            return
+        self._max_price = max(float(self._price[:self._size][active].max()), 1.0)
+        self._max_points = max(float(self._points[:self._size][active].max()), 1.0)
+        self._max_log_stock = np.log1p(max(float(self._stock[:self._size][active].max()), 1.0))
+
+    def recommend(self, tag_counts, k, exclude=(), rng=None):
+        """
+        Returns the top k in-stock products for a user with purchase quantities
+        tag_counts ({TagClass: quantity}), best first. Only TagClasses the user has
+        bought from are considered, and excluded productIds (e.g. the cart) are skipped.
+        rng (a numpy Generator) adds a little exploration noise to the ranking.
+        """
+        total = sum(tag_counts.values())
+        if k <= 0 or total <= 0:
+            return []
+
+        with self._lock:
+            affinity = np.zeros(len(self._tags))
+            buckets = []
+            for tag, count in tag_counts.items():
+                code = self._tags.get(tag)
+                if code is not None and count > 0:
+                    affinity[code] = count / total
+                    buckets.append(self._bucket_array(code))
+            rows = np.concatenate(buckets) if buckets else np.zeros(0, dtype=np.intp)
+            if len(rows) == 0:
+                return []
+
+            user_affinity = affinity[self._tag_codes[rows]]
+            price, points, stock = self._price[rows], self._points[rows], self._stock[rows]
+
+            scores = AFFINITY_WEIGHT * user_affinity
+            scores += SUSTAINABILITY_WEIGHT * points / self._max_points
+            scores -= PRICE_WEIGHT * price / self._max_price
+            scores += STOCK_WEIGHT * np.log1p(np.maximum(stock, 0)) / self._max_log_stock
+            if rng is not None:
+                scores += EXPLORATION_NOISE * rng.random(len(rows))
+
+            valid = stock > 0
+            excluded_rows = [self._rows[product_id] for product_id in exclude if product_id in self._rows]
+            if excluded_rows:
+                valid &= ~np.isin(rows, excluded_rows)
+
+            k = min(k, int(np.count_nonzero(valid)))
+            if k == 0:
+                return []
+
+            scores[~valid] = -np.inf
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [dict(self._products[row]) for row in rows[top]]
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_scoring_engine():
+    """
+    Returns the process-wide scoring engine, subscribed to the product catalogue cache.
+    Also applies the cache's freshness policy, so the engine follows catalogue refreshes.
+    Returns None if the catalogue is unavailable.
+    """
+    global _engine
+    catalogue = get_catalogue()
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                engine = ScoringEngine()
+                catalogue.add_listener(engine.apply)
+                _engine = engine
+    if not catalogue.ensure_fresh():
+        return None
+    return _engine
@@ -1,10 +1,9 @@
-import pika
+import asyncio
 import json
-import time
-import requests
 import logging
 import os
-import utils.amqp_lib as rabbit
+import aiohttp
+import utils.amqp_async as rabbit
 
 # Simple logging configuration
 logging.basicConfig(level=logging.INFO)
@@ -23,6 +22,10 @@ RABBITMQ_PORT = 5672
 EMAIL_EXCHANGE = 'email_exchange'
 EMAIL_QUEUE_NAME = 'send_email_queue'
 
+# EmailJS calls are slow, so many emails are kept in flight on the event loop
+CONSUMER_CONCURRENCY = 100
+EMAILJS_TIMEOUT = aiohttp.ClientTimeout(total=15)
+
 # def send_welcome_email(body):
 #     """
 #     Sends a welcome email via the EmailJS API.
@@ -48,7 +51,25 @@ EMAIL_QUEUE_NAME = 'send_email_queue'
 #     except Exception as e:
 #         logging.error(f"Error while sending email: {e}")
 
-def send_order_email(body):
+async def post_email(session, payload):
+    """
+    Posts an email payload to the EmailJS API.
+    """
+    try:
+        async with session.post(EMAILJS_API_URL, json=payload) as response:
+            text = await response.text()
+            if response.status == 200:
+                logging.info(f"Email sent successfully: {text}")
+                return {"response": {text}}, 200
+            else:
+                logging.error(f"Failed to send email. Response: {response.status} - {text}")
+                return response.status
+    except Exception as e:
+        logging.error(f"Error while sending email: {e}")
+        return {}, 404
+
+
+async def send_order_email(session, body):
     """
     Sends an order confirmation email (currently a placeholder function).
     """
@@ -58,7 +79,6 @@ def send_order_email(body):
     cart = body["cart"]
     print("Extracted Relevant Information")
     # Build list of orders as HTML string to match the EmailJS template
-    total = 0
     orders = []
     logging.info(cart)
     logging.info("cart body")
@@ -67,38 +87,33 @@ def send_order_email(body):
         product_quantity = item["quantity"]
         image_url = item["ImageURL"]
         price = item["Price"]
-        total += price * product_quantity
         product_total = price * product_quantity
         orders += [{"product_name" : product_name,"product_quantity":product_quantity, "image_url":image_url,"price":product_total}]
     logging.info(f"Orders: {orders}")
-    try:
-        payload = {
-            'service_id': EMAILJS_SERVICE_ID,
-            'template_id': ORDER_EMAILJS_TEMPLATE_ID,
-            'user_id': EMAILJS_USER_ID,
-            "template_params": {
-                "email": user_profile["email"],
-                "name": user_profile["name"],
-                "total": f"{total:.2f}",
-                "orders": orders,
-                "delivery": body["delivery"]
-            }
-        }
 
-        response = requests.post(EMAILJS_API_URL, json=payload)
+    # The cart service keeps the running total in exact cents; older messages don't carry it
+    cart_totals = body.get("cart_totals")
+    if cart_totals:
+        total = cart_totals["subtotal_cents"] / 100
+    else:
+        total = sum(order["price"] for order in orders)
+    payload = {
+        'service_id': EMAILJS_SERVICE_ID,
+        'template_id': ORDER_EMAILJS_TEMPLATE_ID,
+        'user_id': EMAILJS_USER_ID,
+        "template_params": {
+            "email": user_profile["email"],
+            "name": user_profile["name"],
+            "total": f"{total:.2f}",
+            "orders": orders,
+            "delivery": body["delivery"]
+        }
+    }
 
-        if response.status_code == 200:
-            logging.info(f"Email sent successfully: {response.text}")
-            return {"response": {response.text}}, 200
-        else:
-            logging.error(f"Failed to send email. Response: {response.status_code} - {response.text}")
-            return response.status_code
-    except Exception as e:
-        logging.error(f"Error while sending email: {e}")
-        return {}, 404
+    return await post_email(session, payload)
 
 
-def send_verification_email(body):
+async def send_verification_email(session, body):
     logging.info("=========================== SENDING VERIFICATION EMAIL =======================================")
     try:
         if body["message"] == "Trade Successful":
@@ -121,19 +136,12 @@ def send_verification_email(body):
                     "is_success": False
                     }
             }
-
-        response = requests.post(EMAILJS_API_URL, json=payload)
-
-        if response.status_code == 200:
-            logging.info(f"Email sent successfully: {response.text}")
-            return {"response": {response.text}}, 200
-        else:
-            logging.error(f"Failed to send email. Response: {response.status_code} - {response.text}")
-            return response.status_code
     except Exception as e:
-        logging.error(f"Error while sending email: {e}")
+        logging.error(f"Error while building verification email: {e}")
         return {}, 404
 
+    return await post_email(session, payload)
+
     # {
     #   "message": "Trade Successful",
     #   "user_details": {
@@ -198,31 +206,39 @@ def send_verification_email(body):
     #     "delivery": ""
     # }
 
-def callback(ch, method, properties, body):
-    """
-    Callback function to process messages from RabbitMQ.
-    """
-    logging.info(f"Received message: {body} ================")
+def make_callback(session):
+    async def callback(message):
+        """
+        Callback function to process messages from RabbitMQ.
+        The message is acked by the consumer once this returns.
+        """
+        body = message.body
+        logging.info(f"Received message: {body} ================")
 
-    try:
-        body = json.loads(body)
-        if body.get("message") == "complete transaction":
-            send_order_email(body)  # pass the parsed dict
-        if "Trade" in body.get("message"):
-            send_verification_email(body)
-    except Exception as e:
-        logging.error(f"Error processing message: {e}")
-    finally:
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+        try:
+            body = json.loads(body)
+            if body.get("message") == "complete transaction":
+                await send_order_email(session, body)  # pass the parsed dict
+            if "Trade" in body.get("message"):
+                await send_verification_email(session, body)
+        except Exception as e:
+            logging.error(f"Error processing message: {e}")
+    return callback
 
-if __name__ == '__main__':
-    # Start consuming messages
 
-    rabbit.connect(RABBITMQ_HOST, RABBITMQ_PORT, EMAIL_EXCHANGE, "direct", {EMAIL_QUEUE_NAME: "send_email"})
+async def main():
+    connection, channel = await rabbit.connect(RABBITMQ_HOST, RABBITMQ_PORT, EMAIL_EXCHANGE, "direct", {EMAIL_QUEUE_NAME: "send_email"})
+    await rabbit.close(connection, channel)
     print("SEND_EMAIL INITIALISED")
 
     # IS A CONSUMER
-    rabbit.start_consuming(RABBITMQ_HOST, RABBITMQ_PORT, EMAIL_EXCHANGE, "direct", EMAIL_QUEUE_NAME, callback=callback)
+    async with aiohttp.ClientSession(timeout=EMAILJS_TIMEOUT) as session:
+        await rabbit.start_consuming(RABBITMQ_HOST, RABBITMQ_PORT, EMAIL_EXCHANGE, "direct", EMAIL_QUEUE_NAME,
+                                     callback=make_callback(session), concurrency=CONSUMER_CONCURRENCY)
+
+if __name__ == '__main__':
+    # Start consuming messages
+    asyncio.run(main())
 
     # send_email-1      | INFO:root:Received message: b'{"message": "complete transaction", "userID": 200, "products": [{"productId": 11, "stock": 2}]}' ================
     # rabbitmq          | 2025-04-07 05:42:06.712040+00:00 [info] <0.962.0> closing AMQP connection (172.18.0.10:51928 -> 172.18.0.2:5672, vhost: '/', user: 'guest', duration: '21ms')
@@ -260,5 +276,6 @@ if __name__ == '__main__':
 #         "productId": 12,
 #         "quantity": 1
 #         }
-#     }
+#     },
+#     "cart_totals": {"subtotal_cents": 3698, "item_count": 1, "sustainability_points": 17}
 # }
@@ -0,0 +1,127 @@
+import asyncio
+import json
+import signal
+import aio_pika
+
+
+async def connect(hostname, port, exchange_name, exchange_type, queues={}, max_retries=12, retry_interval=5):
+    """
+    asyncio counterpart of amqp_lib.connect. Opens a robust (auto-reconnecting)
+    connection, declares the exchange and binds any {queue_name: routing_key} queues.
+    """
+    retries = 0
+    while retries < max_retries:
+        retries += 1
+        try:
+            print(f"=========== Connecting to AMQP broker {hostname}:{port} for {exchange_name}... ===========")
+            connection = await aio_pika.connect_robust(host=hostname, port=port, heartbeat=300)
+            print("Connected")
+            channel = await connection.channel()
+
+            # Declare the exchange explicitly if it doesn't exist
+            print(f"=========== Declaring exchange: {exchange_name} ===========")
+            exchange = await channel.declare_exchange(
+                exchange_name,
+                aio_pika.ExchangeType(exchange_type),
+                durable=True  # Ensure persistence
+            )
+
+            if queues:
+                for queue_name, routing_key in queues.items():
+                    print(f"=========== Declaring queue: {queue_name} for {exchange_name} ===========")
+                    queue = await channel.declare_queue(queue_name, durable=True)
+                    print(f"=========== Binding queue {queue_name} to {exchange_name} with routing key {routing_key} ===========")
+                    await queue.bind(exchange, routing_key=routing_key)
+
+            return connection, channel
+
+        except (aio_pika.exceptions.AMQPConnectionError, ConnectionError, OSError) as exception:
+            print(f"Failed to connect: {exception}")
+            print(f"Retrying in {retry_interval} seconds...")
+            await asyncio.sleep(retry_interval)
+
+    raise Exception(f"Max {max_retries} retries exceeded...")
+
+
+async def close(connection, channel):
+    await channel.close()
+    await connection.close()
+
+
+async def publish_message(channel, exchange_name, routing_key, message_body, properties=None):
+    """
+    Publishes a message to a RabbitMQ exchange with a given routing key.
+    properties are extra aio_pika.Message keyword arguments (headers, message_id, ...).
+    """
+    try:
+        if isinstance(message_body, dict):
+            message_body = json.dumps(message_body)
+        if isinstance(message_body, str):
+            message_body = message_body.encode()
+
+        if exchange_name:
+            exchange = await channel.get_exchange(exchange_name, ensure=False)
+        else:
+            exchange = channel.default_exchange
+
+        message = aio_pika.Message(
+            body=message_body,
+            delivery_mode=aio_pika.DeliveryMode.PERSISTENT,  # Persistent message
+            **(properties or {})
+        )
+        await exchange.publish(message, routing_key=routing_key)
+        print(f"Message published to {exchange_name} with routing key {routing_key}: {message_body}")
+
+    except Exception as e:
+        print(f"Error publishing message: {e}")
+        raise e
+
+
+async def start_consuming(hostname, port, exchange_name, exchange_type, queue_name, callback, concurrency=50, prefetch_count=None, stop_event=None):
+    """
+    Consumes queue_name with an async callback(message) until SIGINT/SIGTERM or stop_event.
+
+    Up to `concurrency` callbacks run at once on the event loop (prefetch_count
+    defaults to the same). A message is acked when its callback returns and
+    rejected without requeue if it raises, unless the callback settled it itself.
+    On shutdown the consumer is cancelled and in-flight callbacks are awaited
+    before the connection closes.
+    """
+    stop_event = stop_event or asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError, ValueError):
+            pass  # Not on the main thread, the caller owns stop_event
+
+    connection, channel = await connect(hostname, port, exchange_name, exchange_type)
+    await channel.set_qos(prefetch_count=prefetch_count or concurrency)
+    queue = await channel.get_queue(queue_name, ensure=True)
+
+    slots = asyncio.Semaphore(concurrency)
+    in_flight = set()
+
+    async def handle(message):
+        async with slots:
+            try:
+                async with message.process(requeue=False, ignore_processed=True):
+                    await callback(message)
+            except Exception as e:
+                print(f"Unhandled error in consumer callback for delivery {message.delivery_tag}: {e}")
+
+    async def on_message(message):
+        task = asyncio.create_task(handle(message))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+
+    print(f"=========== Consuming from queue: {queue_name} (concurrency={concurrency}) ===========")
+    consumer_tag = await queue.consume(on_message)
+
+    await stop_event.wait()
+
+    print(f"=========== Stopping consumer for {queue_name}, waiting on {len(in_flight)} message(s) ===========")
+    await queue.cancel(consumer_tag)
+    if in_flight:
+        await asyncio.gather(*in_flight, return_exceptions=True)
+    await close(connection, channel)
@@ -1,6 +1,12 @@
 import time
 import pika
 import json
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# Errors after which a pooled connection/channel can no longer be trusted
+AMQP_ERRORS = (pika.exceptions.AMQPConnectionError, pika.exceptions.AMQPChannelError)
 
 
 def connect(hostname, port, exchange_name, exchange_type,queues ={}, max_retries=12, retry_interval=5):
@@ -49,9 +55,86 @@ def close(connection, channel):
     connection.close()
 
 
-def start_consuming(hostname, port, exchange_name, exchange_type, queue_name, callback):
+class ThreadSafeChannel:
+    """
+    Channel handed to callbacks that run on worker threads. pika channels are not
+    thread-safe, so acks, nacks and rejects are marshalled back onto the
+    connection's I/O thread; everything else is passed through. Delivery tags
+    a running callback settles are tracked so a failed callback isn't settled twice.
+    """
+
+    def __init__(self, channel):
+        self._channel = channel
+        self.connection = channel.connection
+        self._running = {}  # delivery tag -> settled, for callbacks still running
+        self._running_lock = threading.Lock()
+
+    def _threadsafe(self, callback):
+        try:
+            self.connection.add_callback_threadsafe(callback)
+        except AMQP_ERRORS as e:
+            # The delivery is redelivered once the consumer reconnects
+            print(f"Could not settle message, connection is gone: {e}")
+
+    def _begin(self, delivery_tag):
+        with self._running_lock:
+            self._running[delivery_tag] = False
+
+    def _end(self, delivery_tag):
+        """ Stops tracking a delivery, returning whether its callback settled it """
+        with self._running_lock:
+            return self._running.pop(delivery_tag, False)
+
+    def _mark_settled(self, delivery_tag):
+        with self._running_lock:
+            if delivery_tag in self._running:
+                self._running[delivery_tag] = True
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self._mark_settled(delivery_tag)
+        self._threadsafe(lambda: self._channel.basic_ack(delivery_tag=delivery_tag, multiple=multiple))
+
+    def basic_nack(self, delivery_tag=0, multiple=False, requeue=True):
+        self._mark_settled(delivery_tag)
+        self._threadsafe(lambda: self._channel.basic_nack(delivery_tag=delivery_tag, multiple=multiple, requeue=requeue))
+
+    def basic_reject(self, delivery_tag=0, requeue=True):
+        self._mark_settled(delivery_tag)
+        self._threadsafe(lambda: self._channel.basic_reject(delivery_tag=delivery_tag, requeue=requeue))
+
+    def __getattr__(self, name):
+        return getattr(self._channel, name)
+
+
+def _run_callback(callback, channel, method, properties, body):
+    channel._begin(method.delivery_tag)
+    try:
+        callback(channel, method, properties, body)
+    except Exception as e:
+        # Nothing else would ever see an exception raised on a worker thread
+        print(f"Unhandled error in consumer callback for delivery {method.delivery_tag}: {e}")
+        if not channel._end(method.delivery_tag):
+            # Reject it (dead-lettered if the queue has a DLX) rather than holding a prefetch slot forever
+            channel.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+    else:
+        channel._end(method.delivery_tag)
+
+
+def start_consuming(hostname, port, exchange_name, exchange_type, queue_name, callback, prefetch_count=None, workers=1):
+    """
+    Consumes queue_name with manual acks, reconnecting when the broker drops the connection.
+
+    With workers > 1 callbacks run on a thread pool so one slow message doesn't stall
+    the queue; the channel they receive marshals acks back to the I/O thread, so
+    callbacks written for inline use work unchanged. prefetch_count caps unacked
+    deliveries in flight (defaults to workers when running a pool).
+    """
     connection = None  # Initialize connection variable
     channel = None  # Initialize channel variable
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=queue_name) if workers > 1 else None
+    if executor and not prefetch_count:
+        prefetch_count = workers
+
     while True:
         try:
             connection, channel = connect(
@@ -61,11 +144,21 @@ def start_consuming(hostname, port, exchange_name, exchange_type, queue_name, ca
                 exchange_type=exchange_type,
             )
 
-            print(f"=========== Consuming from queue: {queue_name} ===========")
+            if prefetch_count:
+                channel.basic_qos(prefetch_count=prefetch_count)
+
+            on_message = callback
+            if executor:
+                worker_channel = ThreadSafeChannel(channel)
+
+                def on_message(ch, method, properties, body):
+                    executor.submit(_run_callback, callback, worker_channel, method, properties, body)
+
+            print(f"=========== Consuming from queue: {queue_name} (workers={workers}, prefetch={prefetch_count}) ===========")
             # Use manual acknowledgment (auto_ack=False)
             channel.basic_consume(
                 queue=queue_name,
-                on_message_callback=callback,
+                on_message_callback=on_message,
                 auto_ack=False  # Set auto_ack to False for manual acknowledgment
             )
             channel.start_consuming()
@@ -80,6 +173,9 @@ def start_consuming(hostname, port, exchange_name, exchange_type, queue_name, ca
             continue
 
         except KeyboardInterrupt:
+            if executor:
+                executor.shutdown(wait=True)
+                connection.process_data_events(time_limit=0)  # flush acks queued by the workers
             close(connection, channel)
             break
 
@@ -105,4 +201,364 @@ def publish_message(channel, exchange_name, routing_key, message_body, propertie
 
     except Exception as e:
         print(f"Error publishing message: {e}")
-        raise e
\ No newline at end of file
+        raise e
+
+
+class PublisherPool:
+    """
+    Thread-safe pool of long-lived publishing connections.
+
+    pika connections are not thread-safe, so every pooled connection (and its single
+    channel) is checked out by one thread at a time. Dead connections are dropped and
+    reopened transparently, and exchanges/queues that have already been declared are
+    remembered so the declare round trips are only paid once per process.
+    """
+
+    def __init__(self, hostname, port, max_connections=4, max_retries=3, retry_interval=1):
+        self.hostname = hostname
+        self.port = port
+        self.max_retries = max_retries
+        self.retry_interval = retry_interval
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._declared = set()
+        self._declare_lock = threading.Lock()
+
+    def _open(self):
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                connection = pika.BlockingConnection(
+                    pika.ConnectionParameters(
+                        host=self.hostname,
+                        port=self.port,
+                        heartbeat=300,
+                    )
+                )
+                return connection, connection.channel()
+            except pika.exceptions.AMQPConnectionError as exception:
+                print(f"Publisher failed to connect ({attempt}/{self.max_retries}): {exception}")
+                if attempt < self.max_retries:
+                    time.sleep(self.retry_interval)
+        raise Exception(f"Max {self.max_retries} retries exceeded...")
+
+    def _discard(self, connection):
+        try:
+            if connection.is_open:
+                connection.close()
+        except AMQP_ERRORS:
+            pass
+
+    def _acquire(self):
+        self._slots.acquire()
+        try:
+            try:
+                connection, channel = self._idle.get_nowait()
+            except queue.Empty:
+                return self._open()
+
+            try:
+                # Service heartbeats that piled up while the connection sat idle in the pool
+                connection.process_data_events(time_limit=0)
+                if channel.is_open:
+                    return connection, channel
+            except AMQP_ERRORS:
+                pass
+            self._discard(connection)
+            return self._open()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _release(self, connection, channel):
+        self._idle.put((connection, channel))
+        self._slots.release()
+
+    def _declare(self, channel, exchange_name, exchange_type, queues):
+        if exchange_name and exchange_name not in self._declared:
+            channel.exchange_declare(exchange=exchange_name, exchange_type=exchange_type, durable=True)
+            with self._declare_lock:
+                self._declared.add(exchange_name)
+
+        for queue_name, routing_key in (queues or {}).items():
+            binding = (exchange_name, queue_name, routing_key)
+            if binding in self._declared:
+                continue
+            channel.queue_declare(queue=queue_name, durable=True)
+            channel.queue_bind(exchange=exchange_name, queue=queue_name, routing_key=routing_key)
+            with self._declare_lock:
+                self._declared.add(binding)
+
+    def publish(self, exchange_name, exchange_type, routing_key, message_body, queues=None, properties=None):
+        """
+        Publishes a message over a pooled channel, declaring the exchange (and any
+        queues given as {queue_name: routing_key}) the first time it is used.
+        A publish that fails on a broken connection is retried once on a fresh one.
+        """
+        for attempt in (1, 2):
+            connection, channel = self._acquire()
+            try:
+                self._declare(channel, exchange_name, exchange_type, queues)
+                publish_message(channel, exchange_name, routing_key, message_body, properties)
+            except AMQP_ERRORS as e:
+                self._discard(connection)
+                self._slots.release()
+                if attempt == 2:
+                    raise
+                print(f"Publisher connection lost ({e}), reconnecting...")
+                continue
+            except Exception:
+                self._release(connection, channel)
+                raise
+            self._release(connection, channel)
+            return
+
+    def close(self):
+        while True:
+            try:
+                connection, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(connection)
+
+
+class ConfirmingPublisher:
+    """
+    Publisher with broker confirms that does not pay a round trip per message.
+
+    A pika SelectConnection runs on a background I/O thread with confirm mode
+    enabled on its channel. publish() only queues the message and returns a
+    Future straight away; publishes are pipelined onto the channel and the broker
+    acks them in batches (Basic.Ack with multiple=True), at which point the
+    matching Futures resolve to True. Nacked messages, and messages still
+    unconfirmed when the connection drops, fail their Future with an exception.
+
+    Done-callbacks run on the I/O thread, so they should be quick (e.g. hand an
+    ack back to a consumer connection via add_callback_threadsafe).
+    """
+
+    def __init__(self, hostname, port, retry_interval=5):
+        self.hostname = hostname
+        self.port = port
+        self.retry_interval = retry_interval
+        self._outbox = queue.Queue()
+        self._connection = None
+        self._channel = None
+        self._stopping = False
+        self._declared = set()
+        self._waiting = {}  # declaration key -> messages queued behind it
+        self._pending = {}  # delivery tag -> Future
+        self._next_tag = 0
+        self._lock = threading.Condition()
+        self._counts = {"published": 0, "acked": 0, "nacked": 0, "failed": 0}
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    # ---- public API (any thread) ----
+
+    def publish(self, exchange_name, exchange_type, routing_key, message_body, queues=None, properties=None, callback=None):
+        """
+        Queues a message for publishing and returns a Future that resolves once the
+        broker has confirmed it. If given, callback(future) is attached as a done-callback.
+        """
+        if isinstance(message_body, dict):
+            message_body = json.dumps(message_body)
+        if not properties:
+            properties = pika.BasicProperties(delivery_mode=2)  # Persistent message
+
+        future = Future()
+        if callback:
+            future.add_done_callback(callback)
+
+        key = (exchange_name, exchange_type, tuple(sorted((queues or {}).items())))
+        with self._lock:
+            self._counts["published"] += 1
+        self._outbox.put((key, routing_key, message_body, properties, future))
+        self._wake()
+        return future
+
+    def wait_for_confirms(self, timeout=None):
+        """
+        Blocks until every message published so far has been acked, nacked or failed.
+        Returns False if the timeout expired first.
+        """
+        with self._lock:
+            return self._lock.wait_for(lambda: self._outstanding() == 0, timeout)
+
+    def stats(self):
+        """
+        Snapshot of confirm metrics: messages published, acked, nacked, failed and
+        still outstanding (queued or awaiting a broker confirm).
+        """
+        with self._lock:
+            return dict(self._counts, outstanding=self._outstanding())
+
+    def close(self):
+        self._stopping = True
+        self._wake(lambda: self._connection.close())
+
+    # ---- I/O thread ----
+
+    def _outstanding(self):
+        counts = self._counts
+        return counts["published"] - counts["acked"] - counts["nacked"] - counts["failed"]
+
+    def _wake(self, callback=None):
+        connection = self._connection
+        if connection is None:
+            return
+        try:
+            connection.ioloop.add_callback_threadsafe(callback or self._drain)
+        except Exception:
+            pass  # Connection is being replaced, the outbox is drained once it reopens
+
+    def _run(self):
+        while not self._stopping:
+            print(f"=========== Connecting confirming publisher to {self.hostname}:{self.port}... ===========")
+            self._connection = pika.SelectConnection(
+                pika.ConnectionParameters(host=self.hostname, port=self.port, heartbeat=300),
+                on_open_callback=self._on_connection_open,
+                on_open_error_callback=self._on_connection_error,
+                on_close_callback=self._on_connection_closed,
+            )
+            self._connection.ioloop.start()
+            if not self._stopping:
+                time.sleep(self.retry_interval)
+
+    def _on_connection_open(self, connection):
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_error(self, connection, error):
+        print(f"Confirming publisher failed to connect: {error}")
+        connection.ioloop.stop()
+
+    def _on_connection_closed(self, connection, reason):
+        print(f"Confirming publisher connection closed: {reason}")
+        self._reset(f"Connection closed before broker confirmed message: {reason}")
+        connection.ioloop.stop()
+
+    def _on_channel_open(self, channel):
+        channel.add_on_close_callback(self._on_channel_closed)
+        channel.confirm_delivery(ack_nack_callback=self._on_confirm, callback=lambda _: self._on_ready(channel))
+
+    def _on_channel_closed(self, channel, reason):
+        print(f"Confirming publisher channel closed: {reason}")
+        # The broker closes the channel on a failed declaration, so don't retry what was waiting on it
+        self._reset(f"Channel closed before broker confirmed message: {reason}", requeue=False)
+        if self._connection.is_open:
+            self._connection.close()
+
+    def _on_ready(self, channel):
+        self._channel = channel
+        self._next_tag = 0
+        self._drain()
+
+    def _reset(self, reason, requeue=True):
+        self._channel = None
+        failed = [future for future in self._pending.values()]
+        self._pending = {}
+        # Messages that never reached the channel go back in the outbox for the next connection
+        for items in self._waiting.values():
+            for item in items:
+                if requeue:
+                    self._outbox.put(item)
+                else:
+                    failed.append(item[-1])
+        self._waiting.clear()
+        self._resolve(failed, "failed", Exception(reason))
+
+    def _drain(self):
+        while self._channel is not None:
+            try:
+                item = self._outbox.get_nowait()
+            except queue.Empty:
+                return
+            key = item[0]
+            if key in self._declared:
+                self._send(item)
+            elif key in self._waiting:
+                self._waiting[key].append(item)
+            else:
+                self._waiting[key] = [item]
+                self._declare(key)
+
+    def _declare(self, key):
+        exchange_name, exchange_type, queues = key
+        # Channel RPCs are serialised, so only the last one needs to report completion
+        steps = []
+        if exchange_name:
+            steps.append(lambda cb: self._channel.exchange_declare(
+                exchange=exchange_name, exchange_type=exchange_type, durable=True, callback=cb))
+        for queue_name, routing_key in queues:
+            steps.append(lambda cb, q=queue_name: self._channel.queue_declare(queue=q, durable=True, callback=cb))
+            steps.append(lambda cb, q=queue_name, r=routing_key: self._channel.queue_bind(
+                queue=q, exchange=exchange_name, routing_key=r, callback=cb))
+
+        if not steps:
+            self._on_declared(key)
+            return
+        for step in steps[:-1]:
+            step(None)
+        steps[-1](lambda _: self._on_declared(key))
+
+    def _on_declared(self, key):
+        self._declared.add(key)
+        for item in self._waiting.pop(key, []):
+            if self._channel is None:
+                self._outbox.put(item)
+            else:
+                self._send(item)
+
+    def _send(self, item):
+        key, routing_key, message_body, properties, future = item
+        self._next_tag += 1
+        self._pending[self._next_tag] = future
+        self._channel.basic_publish(
+            exchange=key[0],
+            routing_key=routing_key,
+            body=message_body,
+            properties=properties
+        )
+
+    def _on_confirm(self, frame):
+        method = frame.method
+        if method.multiple:
+            tags = [tag for tag in self._pending if tag <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag]
+        futures = [self._pending.pop(tag) for tag in tags if tag in self._pending]
+
+        if isinstance(method, pika.spec.Basic.Ack):
+            self._resolve(futures, "acked")
+        else:
+            print(f"Broker nacked {len(futures)} message(s) up to delivery tag {method.delivery_tag}")
+            self._resolve(futures, "nacked", Exception(f"Message nacked by broker (delivery tag {method.delivery_tag})"))
+
+    def _resolve(self, futures, outcome, error=None):
+        futures = list(futures)
+        if not futures:
+            return
+        with self._lock:
+            self._counts[outcome] += len(futures)
+            self._lock.notify_all()
+        for future in futures:
+            if error is None:
+                future.set_result(True)
+            else:
+                future.set_exception(error)
+
+
+_publishers = {}
+_publishers_lock = threading.Lock()
+
+
+def get_publisher(hostname, port, confirm=False):
+    """
+    Returns the process-wide publisher for a broker, creating it on first use.
+    With confirm=True this is a ConfirmingPublisher whose publish() returns a Future.
+    """
+    with _publishers_lock:
+        publisher = _publishers.get((hostname, port, confirm))
+        if publisher is None:
+            publisher = ConfirmingPublisher(hostname, port) if confirm else PublisherPool(hostname, port)
+            _publishers[(hostname, port, confirm)] = publisher
+        return publisher
@@ -1,19 +1,258 @@
 import requests
 import logging
+import random
+import threading
+import time
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 
 SUPPORTED_HTTP_METHODS = set([
     "GET", "OPTIONS", "HEAD", "POST", "PUT", "PATCH", "DELETE"
 ])
 
-def invoke_http(url, method='GET', json=None, **kwargs):
+# (connect, read) timeouts in seconds, used unless the caller passes its own
+DEFAULT_TIMEOUT = (3.05, 10)
+
+# Keep-alive connections kept per host, unless overridden with configure_pool()
+DEFAULT_POOL_SIZE = 10
+
+# Threads available to invoke_many/invoke_http_async for concurrent calls
+FANOUT_WORKERS = 32
+
+# Circuit breaker defaults, per target host (see configure_breaker())
+BREAKER_FAILURE_THRESHOLD = 5  # consecutive failures before the circuit opens
+BREAKER_RESET_TIMEOUT = 30  # seconds an open circuit fails fast before letting a probe through
+
+# Safe methods are retried on connection errors, timeouts and these statuses. PUT and
+# DELETE aren't: endpoints like PUT /cart/decrement change state on every call, so a
+# retry after a lost response would apply the change twice.
+RETRYABLE_HTTP_METHODS = set(["GET", "HEAD", "OPTIONS"])
+RETRYABLE_STATUS_CODES = set([502, 503, 504])
+MAX_RETRIES = 2
+RETRY_BACKOFF_BASE = 0.2  # seconds, doubled on every attempt
+RETRY_BACKOFF_MAX = 2
+
+_session = None
+_session_lock = threading.Lock()
+_executor = None
+
+
+def _adapter(pool_size):
+    return HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+
+
+def get_session():
+    """
+    Returns the per-process requests.Session shared by every service call, so
+    connections (and TLS sessions) to each host are kept alive and reused.
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                session.mount("http://", _adapter(DEFAULT_POOL_SIZE))
+                session.mount("https://", _adapter(DEFAULT_POOL_SIZE))
+                _session = session
+    return _session
+
+
+def configure_pool(base_url, pool_size):
+    """
+    Gives a host its own connection pool size, e.g.
+    configure_pool("https://personal-o2kymv2n.outsystemscloud.com", 20).
+    """
+    get_session().mount(base_url.rstrip("/") + "/", _adapter(pool_size))
+
+
+def pool_stats():
+    """
+    Returns one entry per open host pool: connections opened, requests sent,
+    idle keep-alive connections and pool size.
+    """
+    stats = []
+    for prefix, adapter in get_session().adapters.items():
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            stats.append({
+                "mount": prefix,
+                "scheme": pool.scheme,
+                "host": pool.host,
+                "port": pool.port,
+                "num_connections": pool.num_connections,
+                "num_requests": pool.num_requests,
+                "idle": pool.pool.qsize() if pool.pool else 0,
+                "maxsize": pool.pool.maxsize if pool.pool else 0,
+            })
+    return stats
+
+
+class CircuitBreaker:
+    """
+    Per-host circuit breaker. After failure_threshold consecutive failures the
+    circuit opens and calls fail fast; once reset_timeout has passed a single
+    probe is let through (half-open), which closes the circuit on success or
+    reopens it on failure.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, host, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.rejected = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self._transition(self.HALF_OPEN)
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._probing = False
+            if self.state != self.CLOSED:
+                self._transition(self.CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                if self.state != self.OPEN:
+                    self._transition(self.OPEN)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "host": self.host,
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "rejected": self.rejected,
+            }
+
+    def _transition(self, new_state):
+        old_state, self.state = self.state, new_state
+        for listener in list(_breaker_listeners):
+            try:
+                listener(self.host, old_state, new_state)
+            except Exception as e:
+                logging.error(f"Circuit breaker listener failed: {e}")
+
+
+_breakers = {}
+_breaker_settings = {}
+_breaker_listeners = []
+
+
+def _log_transition(host, old_state, new_state):
+    logging.warning(f"Circuit breaker for {host}: {old_state} -> {new_state}")
+
+
+_breaker_listeners.append(_log_transition)
+
+
+def get_breaker(host):
+    breaker = _breakers.get(host)
+    if breaker is None:
+        with _session_lock:
+            breaker = _breakers.get(host)
+            if breaker is None:
+                breaker = CircuitBreaker(host, **_breaker_settings.get(host, {}))
+                _breakers[host] = breaker
+    return breaker
+
+
+def configure_breaker(host, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+    """
+    Overrides the breaker thresholds for one host (e.g. "personal-o2kymv2n.outsystemscloud.com").
+    """
+    with _session_lock:
+        _breaker_settings[host] = {"failure_threshold": failure_threshold, "reset_timeout": reset_timeout}
+        _breakers.pop(host, None)
+
+
+def add_breaker_listener(listener):
+    """
+    Registers a metrics hook called as listener(host, old_state, new_state) on every state change.
+    """
+    _breaker_listeners.append(listener)
+
+
+def breaker_stats():
+    return [breaker.snapshot() for breaker in list(_breakers.values())]
+
+
+def _backoff(attempt):
+    # Exponential backoff with full jitter
+    return random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * (2 ** attempt)))
+
+
+def _request(url, method, json, retries, **kwargs):
+    """
+    Sends the request through the host's circuit breaker, retrying safe
+    methods with backoff. Raises if the circuit is open or every attempt failed.
+    """
+    breaker = get_breaker(urlparse(url).netloc)
+    attempts = 1 + (retries if method.upper() in RETRYABLE_HTTP_METHODS else 0)
+
+    for attempt in range(attempts):
+        if not breaker.allow():
+            raise Exception(f"circuit open for {breaker.host}, failing fast")
+
+        last_attempt = attempt == attempts - 1
+        succeeded = False
+        try:
+            r = get_session().request(method, url, json=json, **kwargs)
+            succeeded = r.status_code < 500
+        except requests.RequestException:
+            if last_attempt:
+                raise
+        else:
+            if r.status_code not in RETRYABLE_STATUS_CODES or last_attempt:
+                return r
+        finally:
+            # Always report the outcome, even for unexpected errors, or a half-open probe never finishes
+            if succeeded:
+                breaker.record_success()
+            else:
+                breaker.record_failure()
+
+        logging.debug(f"Retrying {method} {url} (attempt {attempt + 2}/{attempts})")
+        time.sleep(_backoff(attempt))
+
+
+def invoke_http(url, method='GET', json=None, retries=MAX_RETRIES, **kwargs):
     code = 200
     result = {}
 
     logging.debug(f"Invoking URL: {url} with method: {method} and data: {json}")
 
+    kwargs.setdefault("timeout", DEFAULT_TIMEOUT)
+
     try:
         if method.upper() in SUPPORTED_HTTP_METHODS:
-            r = requests.request(method, url, json=json, **kwargs)
+            r = _request(url, method, json, retries, **kwargs)
         else:
             raise Exception(f"HTTP method {method} unsupported.")
     except Exception as e:
@@ -32,4 +271,31 @@ def invoke_http(url, method='GET', json=None, **kwargs):
         code = 500
         result = {"code": code, "message": "Invalid JSON output from service: " + url + ". " + str(e)}
 
-    return result
\ No newline at end of file
+    return result
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _session_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix="invoke")
+    return _executor
+
+
+def invoke_http_async(url, method='GET', json=None, **kwargs):
+    """
+    Starts invoke_http in the background and returns a Future for its result.
+    """
+    return _get_executor().submit(invoke_http, url, method, json, **kwargs)
+
+
+def invoke_many(calls):
+    """
+    Runs several independent invoke_http calls concurrently and returns their
+    results in the same order. Each call is a dict of invoke_http arguments, e.g.
+    invoke_many([{"url": cart_url}, {"url": profile_url, "method": "GET"}]).
+    Failed calls come back as the same error dicts invoke_http returns.
+    """
+    futures = [invoke_http_async(**call) for call in calls]
+    return [future.result() for future in futures]
@@ -0,0 +1,223 @@
+import threading
+import time
+import logging
+from utils.invokes import invoke_http, invoke_many
+
+# OutSystems product API
+PRODUCT_API_BASE = "https://personal-o2kymv2n.outsystemscloud.com/SustainaMart/rest/v1"
+ALL_PRODUCTS_URL = f"{PRODUCT_API_BASE}/allproducts/"
+SINGLE_PRODUCT_URL = PRODUCT_API_BASE + "/products/{}"
+
+# Entries younger than CACHE_TTL are served as is; up to CACHE_STALE_TTL they are
+# served stale while a background refresh runs; older entries are refetched inline.
+CACHE_TTL = 300
+CACHE_STALE_TTL = 1800
+
+
+class ProductCatalogue:
+    """
+    Read-through cache of the OutSystems product catalogue, keyed by productId.
+
+    Products come either from a full catalogue fetch (get_all/prefetch) or from
+    single-product lookups, and every entry remembers when it was fetched.
+    Callers always get copies, so they are free to mutate what they receive.
+    """
+
+    def __init__(self, ttl=CACHE_TTL, stale_ttl=CACHE_STALE_TTL):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._products = {}  # productId -> (product, fetched_at)
+        self._catalogue_fetched_at = None
+        self._refreshing = set()
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    def add_listener(self, listener):
+        """
+        Registers listener(upserted_products, removed_ids), called whenever products
+        are added or changed (or disappear from a full catalogue fetch). The current
+        contents are replayed to the new listener straight away.
+        """
+        with self._lock:
+            self._listeners.append(listener)
+            current = [dict(product) for product, _ in self._products.values()]
+        if current:
+            listener(current, [])
+
+    def _notify(self, upserted, removed):
+        if not upserted and not removed:
+            return
+        for listener in list(self._listeners):
+            try:
+                listener(upserted, removed)
+            except Exception as e:
+                logging.error(f"Product cache listener failed: {e}")
+
+    # ---- full catalogue ----
+
+    def prefetch(self):
+        """
+        Fetches the full catalogue in one call and replaces the cached entries.
+        Returns False if the product API could not be reached.
+        """
+        response = invoke_http(ALL_PRODUCTS_URL, "GET")
+        if not isinstance(response, dict) or "Products" not in response:
+            logging.error(f"Error fetching product catalogue: {response}")
+            return False
+
+        fetched_at = time.monotonic()
+        products = {int(product["productId"]): product for product in response["Products"]}
+        with self._lock:
+            previous = self._products
+            self._products = {product_id: (product, fetched_at) for product_id, product in products.items()}
+            self._catalogue_fetched_at = fetched_at
+
+        upserted = [
+            dict(product) for product_id, product in products.items()
+            if previous.get(product_id, (None,))[0] != product
+        ]
+        removed = [product_id for product_id in previous if product_id not in products]
+        self._notify(upserted, removed)
+        return True
+
+    def ensure_fresh(self):
+        """
+        Applies the TTL/stale-while-revalidate policy to the full catalogue without
+        copying it. Returns False if the catalogue is unavailable.
+        """
+        age = self._age(self._catalogue_fetched_at)
+        if age is None or age >= self.stale_ttl:
+            if not self.prefetch() and self._catalogue_fetched_at is None:
+                return False
+        elif age >= self.ttl:
+            self._refresh_in_background("__all__", self.prefetch)
+        return True
+
+    def get_all(self):
+        """
+        Returns every product, or None if the catalogue is unavailable.
+        """
+        if not self.ensure_fresh():
+            return None
+
+        with self._lock:
+            return [dict(product) for product, _ in self._products.values()]
+
+    # ---- single products ----
+
+    def _fetch_one(self, product_id):
+        response = invoke_http(SINGLE_PRODUCT_URL.format(product_id), "GET")
+        return self._store_one(product_id, response)
+
+    def _store_one(self, product_id, response):
+        if not isinstance(response, dict) or not response.get("Result", {}).get("Success"):
+            return None
+        product = response.get("Product")
+        if not product:
+            return None
+        with self._lock:
+            previous = self._products.get(int(product_id), (None,))[0]
+            self._products[int(product_id)] = (product, time.monotonic())
+        if previous != product:
+            self._notify([dict(product)], [])
+        return dict(product)
+
+    def get(self, product_id, max_age=None):
+        """
+        Returns one product (or None if it doesn't exist / can't be fetched).
+
+        max_age (seconds) is for stock-sensitive reads: anything older is refetched
+        inline and never served stale. max_age=0 always goes to the product API.
+        """
+        product_id = int(product_id)
+        with self._lock:
+            product, fetched_at = self._products.get(product_id, (None, None))
+        age = self._age(fetched_at)
+
+        if max_age is not None:
+            if age is not None and age < max_age:
+                return dict(product)
+            return self._fetch_one(product_id)
+
+        if age is None or age >= self.stale_ttl:
+            return self._fetch_one(product_id) or (dict(product) if product else None)
+        if age >= self.ttl:
+            self._refresh_in_background(product_id, lambda: self._fetch_one(product_id))
+        return dict(product)
+
+    def get_many(self, product_ids, max_age=None):
+        """
+        Returns {productId: product} for the ids that exist. Cached entries are used
+        as is; missing or expired ones (older than max_age, if given) are fetched
+        concurrently in one pass.
+        """
+        found, missing = {}, []
+        now = time.monotonic()
+        limit = self.stale_ttl if max_age is None else max_age
+        with self._lock:
+            for product_id in {int(product_id) for product_id in product_ids}:
+                product, fetched_at = self._products.get(product_id, (None, None))
+                if product is not None and now - fetched_at < limit:
+                    found[product_id] = dict(product)
+                else:
+                    missing.append(product_id)
+
+        if missing:
+            responses = invoke_many([
+                {"url": SINGLE_PRODUCT_URL.format(product_id), "method": "GET"}
+                for product_id in missing
+            ])
+            for product_id, response in zip(missing, responses):
+                product = self._store_one(product_id, response)
+                if product:
+                    found[product_id] = product
+        return found
+
+    def invalidate(self, product_id=None):
+        """
+        Drops one product, or the whole catalogue when no id is given.
+        """
+        with self._lock:
+            if product_id is None:
+                self._products = {}
+                self._catalogue_fetched_at = None
+            else:
+                self._products.pop(int(product_id), None)
+
+    # ---- helpers ----
+
+    def _age(self, fetched_at):
+        return None if fetched_at is None else time.monotonic() - fetched_at
+
+    def _refresh_in_background(self, key, refresh):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def run():
+            try:
+                refresh()
+            except Exception as e:
+                logging.error(f"Background refresh of product cache ({key}) failed: {e}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=run, daemon=True).start()
+
+
+_catalogue = None
+_catalogue_lock = threading.Lock()
+
+
+def get_catalogue():
+    """
+    Returns the per-process product catalogue cache.
+    """
+    global _catalogue
+    if _catalogue is None:
+        with _catalogue_lock:
+            if _catalogue is None:
+                _catalogue = ProductCatalogue()
+    return _catalogue